@@ -1,50 +1,339 @@
-import os
+import functools
+import io
 import json
-import sys
-import traceback
 
-from flask import Flask, make_response, jsonify, request, _request_ctx_stack
-from flask_restful import abort, Api, reqparse, Resource
+import click
+from flask import Flask, Request, Response, request, _request_ctx_stack
+from flask_restful import abort, Api, Resource
 from flask_cors import cross_origin, CORS
-from dotenv import load_dotenv
-from cerberus import Validator
-
-
+from pymongo.errors import ExecutionTimeout
+from werkzeug.wsgi import wrap_file
+
+
+from app.config import (MONGO_URI, DB_NAME, AUTH0_DOMAIN, API_AUDIENCE,
+                        ALGORITHMS, VIDEOCALL_CODE_SIZE, AUTH0_JWKS_URL,
+                        JWKS_CACHE_TTL, JWKS_MIN_REFRESH_INTERVAL,
+                        TOKEN_CACHE_SIZE, MAX_PAGE_SIZE, DEFAULT_PAGE_SIZE,
+                        MAX_BATCH_PATIENTS,
+                        DIAGNOSTIC_BATCH_MAX_SIZE, STREAM_BATCH_SIZE,
+                        SUMMARY_CACHE_TTL, SUMMARY_RECONCILE_INTERVAL,
+                        ENSURE_INDEXES, MONGO_CLIENT_OPTIONS, JSON_PROVIDER,
+                        SLOW_QUERY_MS, EXPLAIN_SLOW_QUERIES,
+                        HEALTH_CHECK_INTERVAL, FEEDBACK_BUFFER_DIR,
+                        FEEDBACK_BUFFER_SIZE, FEEDBACK_FLUSH_SIZE,
+                        FEEDBACK_FLUSH_INTERVAL, MAX_PHOTO_BYTES,
+                        MAX_REQUEST_BYTES,
+                        COMPRESSION_ENCODINGS, COMPRESSION_MIN_SIZE,
+                        COMPRESSION_LEVELS, MONGO_MAX_TIME_MS,
+                        SECONDARY_READS, MONGO_MAX_STALENESS_SECONDS,
+                        MONGO_WRITE_TIMEOUT_MS, REPORT_CACHE_SIZE,
+                        REPORT_CACHE_TTL, REPORT_CACHE_FALLBACK_TTL)
+from app.database.db_policy import PolicyDatabase, query_policies
 from app.database.db_setup import get_connection
-from app.database.db_queries_diagnostic import post_patient_id, get_patient_id
+from app.database.db_indexes import (ensure_indexes, index_report,
+                                     remove_duplicates, MissingIndexError)
+from app.database.pagination import InvalidPageToken
+from app.database.projection import InvalidFields, parse_fields
+from app.database.report_cache import ReportCache
+from app.database.write_behind import BufferFull, WriteBehindBuffer
+from app.database.db_queries_diagnostic import (post_patient_id,
+                                                get_patient_id,
+                                                get_last_conducts,
+                                                get_diagnostics_version,
+                                                post_diagnostics)
 from app.database.db_queries_appointment import (post_appointment,
                                                  modify_appointment,
                                                  get_appointment,
-                                                 get_summary)
-from app.database.db_queries_report import create_replace_report, get_report_id
+                                                 get_summary,
+                                                 reconcile_summary,
+                                                 claim_summary_reconciliation)
+from app.database.db_queries_report import (create_replace_report,
+                                            get_report_id,
+                                            get_report_last_update)
 from app.helpers.auth import AuthHandler, AuthError
-from app.database.db_queries_doctors import post_doctor_id, get_doctor_application, modify_doctor
-from app.database.db_queries_feedback import post_feedback, get_feedback
+from app.helpers.background import run_periodically
+from app.helpers.health import HealthProber
+from app.helpers import metrics
+from app.helpers.compression import Compression, compressed_chunks, weak_etag
+from app.helpers.json_provider import get_provider
+from app.helpers.conditional import (make_etag, is_not_modified,
+                                     not_modified_response, set_validators,
+                                     immutable_headers, pop_last_update)
+from app.helpers.photos import decode_photo, photo_content_type
+from app.helpers.validators import (DIAGNOSTIC_SCHEMA,
+                                    DOCTOR_REGISTRATION_SCHEMA,
+                                    DOCTOR_APPLICATION_SCHEMA,
+                                    DOCTOR_APPLICATION_FORM_SCHEMA,
+                                    REPORT_SCHEMA, FEEDBACK_SCHEMA,
+                                    diagnostic_parser,
+                                    appointment_parser)
+from app.database.db_queries_doctors import (post_doctor_id,
+                                             get_doctor_application,
+                                             modify_doctor, store_photo,
+                                             open_photo, delete_photos,
+                                             migrate_photos, PhotoTooLarge,
+                                             PHOTO_FIELDS)
+from app.database.db_queries_feedback import (post_feedback, get_feedback,
+                                              buffer_feedback,
+                                              post_feedback_batch)
+
+json_provider = get_provider(JSON_PROVIDER)
+
+
+class JSONRequest(Request):
+    # Request bodies are decoded with the same provider responses use.
+    json_module = json_provider
+
+    def get_json(self, *args, **kwargs):
+        with metrics.phase('serialisation'):
+            return super().get_json(*args, **kwargs)
+
+
+def track_metrics(view):
+    """Records latency, phases and status of every Resource method. Time
+       is measured until the response is built, before a streamed body is
+       sent.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with metrics.track_request(request.method, request.url_rule.rule) as tracked:
+            response = view(*args, **kwargs)
+            tracked.status = response.status_code
+            return response
+    return wrapper
+
+
+def query_timeouts(view):
+    """Answers 503 when a query ran out of its maxTimeMS."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            return view(*args, **kwargs)
+        except ExecutionTimeout:
+            return query_timeout_response()
+    return wrapper
 
-load_dotenv()
 
 app = Flask(__name__)
+app.request_class = JSONRequest
 app.url_map.strict_slashes = False
-api = Api(app)
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+api = Api(app, decorators=[query_timeouts, track_metrics])
 CORS(app=app)
 
-# Environment Variables
-MONGO_URI = os.getenv('MONGO_URI')
-DB_NAME = os.getenv('DB_NAME')
-AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
-API_AUDIENCE = os.getenv('API_AUDIENCE')
-ALGORITHMS = os.getenv('ALGORITHMS')
-VIDEOCALL_CODE_SIZE = int(os.getenv('VIDEOCALL_CODE_SIZE'))
-
-# Manage Database Connection
-db_client = get_connection(mongo_uri=MONGO_URI)
-db = db_client[DB_NAME]
+# Manage Database Connection. The client itself is created on first use in
+# each process, so workers forked by gunicorn --preload get their own pool.
+db_client = get_connection(mongo_uri=MONGO_URI,
+                           slow_query_ms=SLOW_QUERY_MS if SLOW_QUERY_MS >= 0 else None,
+                           explain_slow_queries=EXPLAIN_SLOW_QUERIES,
+                           **MONGO_CLIENT_OPTIONS)
+# Read preference, concerns and time limit of each query function.
+db = PolicyDatabase(db_client[DB_NAME], query_policies(
+    max_time_ms=MONGO_MAX_TIME_MS, secondary_reads=SECONDARY_READS,
+    max_staleness=MONGO_MAX_STALENESS_SECONDS,
+    write_timeout_ms=MONGO_WRITE_TIMEOUT_MS))
+
+# A missing unique index lets duplicates in, so the app doesn't start
+# without it.
+if ENSURE_INDEXES:
+    ensure_indexes(db, strict=True)
 
 auth_handler = AuthHandler(auth0_domain=AUTH0_DOMAIN, algorithms=ALGORITHMS,
-                           api_identifier=API_AUDIENCE)
+                           api_identifier=API_AUDIENCE,
+                           jwks_ttl=JWKS_CACHE_TTL,
+                           jwks_min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                           token_cache_size=TOKEN_CACHE_SIZE,
+                           jwks_url=AUTH0_JWKS_URL)
+
+report_cache = ReportCache(max_size=REPORT_CACHE_SIZE, ttl=REPORT_CACHE_TTL,
+                           fallback_ttl=REPORT_CACHE_FALLBACK_TTL)
+
+feedback_buffer = WriteBehindBuffer(
+    'feedback', lambda feedbacks: post_feedback_batch(db, feedbacks),
+    FEEDBACK_BUFFER_DIR, max_size=FEEDBACK_BUFFER_SIZE,
+    flush_size=FEEDBACK_FLUSH_SIZE,
+    flush_interval=FEEDBACK_FLUSH_INTERVAL) if FEEDBACK_BUFFER_DIR else None
+
+# Probes are answered from the last background check, never on the request
+# path.
+health_prober = HealthProber({
+    'mongo': lambda: db_client.admin.command('ping'),
+    'jwks': auth_handler.jwks.check
+}, interval=HEALTH_CHECK_INTERVAL)
+
+@app.before_first_request
+def start_background_jobs():
+    # Threads don't survive a fork, so jobs start in each worker.
+    run_periodically(health_prober.probe, HEALTH_CHECK_INTERVAL,
+                     'health-check', immediately=True)
+    if SUMMARY_RECONCILE_INTERVAL > 0:
+        # Every worker tries, the one that gets the lease recounts.
+        run_periodically(
+            lambda: (claim_summary_reconciliation(db, SUMMARY_RECONCILE_INTERVAL)
+                     and reconcile_summary(db)),
+            SUMMARY_RECONCILE_INTERVAL, 'reconcile-summary')
+    if REPORT_CACHE_SIZE:
+        # The stream blocks its thread; it is reopened when it ends or fails.
+        run_periodically(lambda: report_cache.watch(db), 30,
+                         'report-cache-watch', immediately=True)
+
+
+compression = Compression.from_names(COMPRESSION_ENCODINGS, COMPRESSION_LEVELS,
+                                    min_size=COMPRESSION_MIN_SIZE)
+
+
+@app.after_request
+def compress_response(response):
+    """Encodes JSON bodies, streamed ones included, with the best encoding
+       the client accepts.
+    """
+    if response.direct_passthrough or not compression.compressible(
+            response.status_code, response.mimetype,
+            response.headers.get('Content-Encoding')):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoder = compression.negotiate(request.headers.get('Accept-Encoding'))
+    if encoder is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compressed_chunks(encoder, response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < compression.min_size:
+            return response
+        response.set_data(encoder.compress(data))
+    response.headers['Content-Encoding'] = encoder.name
+    if 'ETag' in response.headers:
+        response.headers['ETag'] = weak_etag(response.headers['ETag'])
+    return response
+
 
 def custom_response(message, status_code):
-    return make_response(jsonify(message), status_code)
+    with metrics.phase('serialisation'):
+        body = json_provider.dumps(message) + b'\n'
+    return Response(body, status_code, mimetype='application/json')
+
+
+def stream_response(code, documents, limit=None, next_token=None):
+    """Sends ``documents`` in the usual found envelope, encoding them in
+       batches while they are read instead of building the whole list first.
+       Returns None if there are no documents so the caller can answer 404.
+    """
+    documents = iter(documents)
+    first = next(documents, None)
+    if first is None:
+        return None
+    dumps = json_provider.dumps
+
+    def generate():
+        try:
+            yield b'{"code":%s,"message":[' % dumps(code)
+            batch = [dumps(first)]
+            separator = b''
+            for document in documents:
+                batch.append(dumps(document))
+                if len(batch) >= STREAM_BATCH_SIZE:
+                    yield separator + b','.join(batch)
+                    batch, separator = [], b','
+            if batch:
+                yield separator + b','.join(batch)
+            if limit:
+                yield b'],"next":%s}\n' % dumps(next_token)
+            else:
+                yield b']}\n'
+        finally:
+            if hasattr(documents, 'close'):
+                documents.close()
+
+    return Response(generate(), 200, mimetype='application/json')
+
+
+def stream_args(args):
+    """Returns the cursor batch size to use if the client asked for a
+       streamed response.
+    """
+    return STREAM_BATCH_SIZE if args.get('stream') else None
+
+
+def page_args(args):
+    """Reads the ``limit`` and ``next`` pagination parameters.
+       Returns the limit (DEFAULT_PAGE_SIZE when absent, None for a streamed
+       response without one), the next page token and an error response if
+       the limit is invalid.
+    """
+    if 'limit' not in args:
+        # Only a streamed response may hold the whole result.
+        limit = None if stream_args(args) else DEFAULT_PAGE_SIZE
+        return limit, args.get('next'), None
+
+    try:
+        limit = int(args['limit'])
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        return None, None, custom_response({
+            "code": "invalid limit",
+            "message": {
+                "eng": "limit must be between 1 and %d" % MAX_PAGE_SIZE,
+                "esp": "limit debe estar entre 1 y %d" % MAX_PAGE_SIZE
+            }}, 400)
+
+    return limit, args.get('next'), None
+
+
+def invalid_page_token_response():
+    return custom_response({
+        "code": "invalid page token",
+        "message": {
+            "eng": "the next page token is not valid",
+            "esp": "el token de la siguiente pagina no es valido"
+        }}, 400)
+
+
+def invalid_fields_response(error):
+    allowed = ', '.join(error.allowed)
+    return custom_response({
+        "code": "invalid fields",
+        "message": {
+            "eng": "fields must be a comma separated list of: %s" % allowed,
+            "esp": "fields debe ser una lista separada por comas de: %s" % allowed
+        }}, 400)
+
+
+def query_timeout_response():
+    response = custom_response({
+        "code": "query timed out",
+        "message": {
+            "esp": "la consulta tardó demasiado, intente de nuevo",
+            "eng": "the query took too long, try again"
+        }}, 503)
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+@app.before_request
+def reject_large_requests():
+    """Answers 413 from the Content-Length, before the body is read."""
+    if (request.content_length or 0) > app.config['MAX_CONTENT_LENGTH']:
+        return custom_response({
+            "code": "request too large",
+            "message": {
+                "esp": "la solicitud supera %d bytes" % MAX_REQUEST_BYTES,
+                "eng": "the request is larger than %d bytes" % MAX_REQUEST_BYTES
+            }}, 413)
+
+
+def page_response(code, items, limit, next_token):
+    """Builds the found response, adding the next page token when the
+       client asked for a page.
+    """
+    body = {"code": code, "message": items}
+    if limit:
+        body["next"] = next_token
+    return custom_response(body, 200)
 
 
 class Diagnostic(Resource):
@@ -57,22 +346,14 @@ class Diagnostic(Resource):
             returns OK HTTP 200
             return BAD_REQUEST HTTP 400 if bad JSON
         """
-        parser = reqparse.RequestParser()
         token_valid = auth_handler.get_payload(request)
         if isinstance(token_valid, AuthError):
             return custom_response(token_valid.error, token_valid.status_code)
 
-        parser.add_argument('patient_id', type=str, required=True, help='ID of patient. (Required)')
-        parser.add_argument('diagnose', type=str, required=True, help='Diagnose of the patient')
-        parser.add_argument('doctor_id', type=str, required=True, help='ID of the doctor')
-        parser.add_argument('report_id', type=str, required=True, help='ID of the report')
-        parser.add_argument('conduct', type=str, required=True, help='Recommendation for the patient required')
-        parser.add_argument('risk', type=str, required=False, help='Risk of the patient required',
-                            choices=(None, 'low', 'medium', 'high'))
-
-        patient_info = parser.parse_args()
+        patient_info = diagnostic_parser.parse_args()
 
         result = post_patient_id(patient_info, db)
+        report_cache.invalidate(patient_info['report_id'])
 
         if result['operation'] == 'update':
 
@@ -110,14 +391,15 @@ class Diagnostic(Resource):
         """ Receives a json containing _id, and returns user
             information.
         """
-        parser = reqparse.RequestParser()
-
         token_valid = auth_handler.get_payload(request)
         if isinstance(token_valid, AuthError):
             return custom_response(token_valid.error, token_valid.status_code)
 
         args = request.args.to_dict()
 
+        if 'patient_ids' in args:
+            return self.get_last_conducts()
+
         if 'patient_id' not in args and 'doctor_id' not in args and 'report_id' not in args:
             return custom_response({
                 "code": "missing parameter",
@@ -131,14 +413,111 @@ class Diagnostic(Resource):
         report_id = (args['report_id'] if 'report_id' in args else None)
         last_conduct = (args['last_conduct'] if 'last_conduct' in args else False)
 
-        patient_info = get_patient_id(db, patient_id=patient_id,
-                                      doctor_id=doctor_id,
-                                      report_id=report_id,
-                                      last_conduct=last_conduct
-                                      )
+        limit, next_token, error = page_args(args)
+        if error:
+            return error
+
+        fields = parse_fields(args.get('fields'))
+        # The latest diagnostic of a report is polled, so it is cached.
+        cached = (report_id and last_conduct and not patient_id
+                  and not doctor_id and not stream_args(args))
+
+        # Validators are derived from the diagnostics returned. A conditional
+        # request for a first page is first checked against the version of
+        # the whole list, which doesn't fetch them; it only matches when the
+        # list fits in the page.
+        versioned = not stream_args(args)
+        if (versioned and not next_token
+                and (request.if_none_match or request.if_modified_since)):
+            load_version = functools.partial(get_diagnostics_version, db,
+                                             patient_id=patient_id,
+                                             doctor_id=doctor_id,
+                                             report_id=report_id,
+                                             last_conduct=last_conduct)
+            last_update, count = (report_cache.load(('diagnostics_version', report_id),
+                                                    load_version)
+                                  if cached else load_version())
+            if last_update:
+                validators = (make_etag(last_update, count, sorted(args.items())),
+                              last_update)
+                if is_not_modified(request.headers, *validators):
+                    return not_modified_response(*validators)
+
+        load_diagnostics = functools.partial(get_patient_id, db,
+                                             patient_id=patient_id,
+                                             doctor_id=doctor_id,
+                                             report_id=report_id,
+                                             last_conduct=last_conduct,
+                                             limit=limit,
+                                             next_token=next_token,
+                                             stream_batch_size=stream_args(args),
+                                             fields=fields,
+                                             with_last_update=versioned)
+        try:
+            if cached:
+                patient_info, next_token = report_cache.load(
+                    ('last_diagnostic', report_id,
+                     None if fields is None else tuple(fields)),
+                    load_diagnostics)
+            else:
+                patient_info, next_token = load_diagnostics()
+        except InvalidPageToken:
+            return invalid_page_token_response()
+        except InvalidFields as error:
+            return invalid_fields_response(error)
+
+        if stream_args(args):
+            response = stream_response("diagnostics found", patient_info,
+                                       limit, next_token)
+            if response:
+                return response
+            patient_info = []
+
+        if not patient_info:
+            return custom_response({
+                "code": "diagnoses non existent",
+                "message": {
+                    "eng": "diagnoses non existent for those parameters",
+                    "esp": "diagnostico no existente para esos parametros de busqueda"
+                }}, 404)
+
+        validators = None
+        if versioned:
+            last_update, patient_info = pop_last_update(patient_info)
+            if last_update:
+                validators = (make_etag(last_update, len(patient_info),
+                                        sorted(args.items())), last_update)
+                if is_not_modified(request.headers, *validators):
+                    return not_modified_response(*validators)
+
+        response = page_response("diagnostics found", patient_info, limit, next_token)
+        return set_validators(response, *validators) if validators else response
+
+
+    def get_last_conducts(self):
+        """ Returns the most recent diagnostic of every patient in the
+            comma separated patient_ids parameter.
+        """
+        patient_ids = {patient_id
+                       for value in request.args.getlist('patient_ids')
+                       for patient_id in value.split(',') if patient_id}
+
+        if not patient_ids or len(patient_ids) > MAX_BATCH_PATIENTS:
+            return custom_response({
+                "code": "invalid parameter",
+                "message": {
+                    "eng": "between 1 and %d patient ids required" % MAX_BATCH_PATIENTS,
+                    "esp": "se requieren entre 1 y %d identificaciones de pacientes" % MAX_BATCH_PATIENTS
+                }}, 400)
+
+        try:
+            last_conducts = get_last_conducts(
+                db, patient_ids, fields=parse_fields(request.args.get('fields')))
+        except InvalidFields as error:
+            return invalid_fields_response(error)
 
-        return custom_response({"code": "diagnostics found", "message": patient_info},
-                               200) if patient_info else custom_response({
+        return custom_response({"code": "diagnostics found", "message": last_conducts},
+                               200) if last_conducts else custom_response({
                                "code": "diagnoses non existent",
                                "message": {
                                     "eng": "diagnoses non existent for those parameters",
@@ -146,29 +525,80 @@ class Diagnostic(Resource):
                                }}, 404)
 
 
+class DiagnosticBatch(Resource):
+
+    @cross_origin(headers=["Content-Type", "Authorization"])
+    def put(self):
+        """ Receives a json array of diagnostics with the same fields as
+            PUT /diagnostic and creates or updates all of them at once.
+            Returns the result of each diagnostic in the same order.
+        """
+        token_valid = auth_handler.get_payload(request)
+        if isinstance(token_valid, AuthError):
+            return custom_response(token_valid.error, token_valid.status_code)
+
+        try:
+            body = request.get_json()
+        except:
+            body = None
+
+        if not isinstance(body, list) or not 0 < len(body) <= DIAGNOSTIC_BATCH_MAX_SIZE:
+            return custom_response({
+                "code": "invalid json structure",
+                "message": {
+                    "esp": "se espera una lista de entre 1 y %d diagnosticos" % DIAGNOSTIC_BATCH_MAX_SIZE,
+                    "eng": "a list of between 1 and %d diagnostics is expected" % DIAGNOSTIC_BATCH_MAX_SIZE
+                }}, 400)
+
+        validator = DIAGNOSTIC_SCHEMA.validator
+
+        results = [None] * len(body)
+        valid = []
+        for index, patient_info in enumerate(body):
+            if isinstance(patient_info, dict) and validator.validate(patient_info):
+                valid.append(index)
+            else:
+                results[index] = {'index': index, 'status': 'error',
+                                  'errors': validator.errors if isinstance(patient_info, dict)
+                                            else 'must be of dict type'}
+
+        if valid:
+            statuses = post_diagnostics(db, [body[index] for index in valid])
+            for index in valid:
+                report_cache.invalidate(body[index]['report_id'])
+            for index, status in zip(valid, statuses):
+                status['index'] = index
+                results[index] = status
+
+        failed = any(result['status'] == 'error' for result in results)
+        return custom_response({
+            "code": "diagnostics processed",
+            "message": results
+        }, 207 if failed else 200)
+
+
 class Appointment(Resource):
     @cross_origin(headers=["Content-Type", "Authorization"])
     def post(self):
         """ Receives appointment information
             doctor_id, patient_id, videocall_code, informed_consent_accepted
         """
-        parser = reqparse.RequestParser()
         token_valid = auth_handler.get_payload(request)
         if isinstance(token_valid, AuthError):
             return custom_response(token_valid.error, token_valid.status_code)
 
-        parser.add_argument('patient_id', type=str, required=True,
-                            help='ID of patient. (Required)')
-        parser.add_argument('doctor_id', type=str, required=True,
-                            help='ID of the doctor')
-        parser.add_argument('informed_consent_accepted', type=bool,
-                            required=False)
-
-        appointment_info = parser.parse_args()
+        appointment_info = appointment_parser.parse_args()
 
-        ack, creation_date, videocall_code = post_appointment(db,
-                                                              appointment_info,
-                                                              VIDEOCALL_CODE_SIZE)
+        try:
+            ack, creation_date, videocall_code = post_appointment(
+                db, appointment_info, VIDEOCALL_CODE_SIZE)
+        except MissingIndexError:
+            return custom_response({
+                "code": "service unavailable",
+                "message": {
+                    "esp": "no se pueden crear citas en este momento, contacte administrador",
+                    "eng": "appointments can't be created right now, contact admin"
+                }}, 503)
 
         if ack:
             return custom_response({
@@ -191,12 +621,10 @@ class Appointment(Resource):
     def get(self):
         """ Get appointment information by doctor_id, patient_id or both.
         """
-        parser = reqparse.RequestParser()
-
         args = request.args.to_dict()
 
         if 'summary' in args and args['summary']:
-            summary = get_summary(db)
+            summary = get_summary(db, cache_ttl=SUMMARY_CACHE_TTL)
             return custom_response({"code": "summary", "message": {"accepted_consent_videocalls": summary}}, 200)
 
         token_valid = auth_handler.get_payload(request)
@@ -214,10 +642,31 @@ class Appointment(Resource):
         patient_id = (args['patient_id'] if 'patient_id' in args else None)
         doctor_id = (args['doctor_id'] if 'doctor_id' in args else None)
 
-        appointment_info = get_appointment(db, patient_id=patient_id, doctor_id=doctor_id)
+        limit, next_token, error = page_args(args)
+        if error:
+            return error
 
-        return custom_response({"code": "appointments found", "message": appointment_info},
-                               200) if appointment_info else custom_response({
+        try:
+            appointment_info, next_token = get_appointment(db, patient_id=patient_id,
+                                                           doctor_id=doctor_id,
+                                                           limit=limit,
+                                                           next_token=next_token,
+                                                           stream_batch_size=stream_args(args),
+                                                           fields=parse_fields(args.get('fields')))
+        except InvalidPageToken:
+            return invalid_page_token_response()
+        except InvalidFields as error:
+            return invalid_fields_response(error)
+
+        if stream_args(args):
+            response = stream_response("appointments found", appointment_info,
+                                       limit, next_token)
+            if response:
+                return response
+            appointment_info = []
+
+        return page_response("appointments found", appointment_info, limit,
+                             next_token) if appointment_info else custom_response({
                                "code": "appointments non existent",
                                "message": {
                                     "esp": "citas no encontradas",
@@ -263,15 +712,25 @@ class Appointment(Resource):
 class Doctor(Resource):
     @cross_origin(headers=["Content-Type", "Authorization"])
     def get(self):
-        parser = reqparse.RequestParser()
         token_valid = auth_handler.get_payload(request)
         if isinstance(token_valid, AuthError):
             return custom_response(token_valid.error, token_valid.status_code)
 
-        doctor_application = get_doctor_application(db)
+        limit, next_token, error = page_args(request.args)
+        if error:
+            return error
 
-        return (custom_response({"code": "Application found", "message": doctor_application},
-                               200) if doctor_application else custom_response({
+        try:
+            doctor_application, next_token = get_doctor_application(
+                db, limit=limit, next_token=next_token,
+                fields=parse_fields(request.args.get('fields')))
+        except InvalidPageToken:
+            return invalid_page_token_response()
+        except InvalidFields as error:
+            return invalid_fields_response(error)
+
+        return (page_response("Application found", doctor_application, limit,
+                              next_token) if doctor_application else custom_response({
                                "code": "Application is non existent",
                                "message": {
                                     "esp": "Aplicación no encontradas",
@@ -280,7 +739,6 @@ class Doctor(Resource):
 
     @cross_origin(headers=["Content-Type", "Authorization"])
     def patch(self):
-        parser = reqparse.RequestParser()
         token_valid = auth_handler.get_payload(request)
         if isinstance(token_valid, AuthError):
             return custom_response(token_valid.error, token_valid.status_code)
@@ -294,14 +752,7 @@ class Doctor(Resource):
                     "eng": "JSON with invalid syntax"
                 }}, 400)
 
-        email_regex = '(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)'
-
-        schema = {
-                    'cellphone': {'type': 'string','required':True, 'regex': '[0-9]{10}'},
-                    'email': {'type': 'string','required':True, 'regex': email_regex},
-                    'registered' : {'type' : 'boolean', 'required': True}
-                }
-        validator = Validator(schema)
+        validator = DOCTOR_REGISTRATION_SCHEMA.validator
 
         if not validator.validate(body):
             return custom_response({'code': 'invalid json structure',
@@ -327,32 +778,61 @@ class Doctor(Resource):
             }}, 404 if not result['n_matched'] else 202)
 
     def post(self):
+        """Creates an application from a JSON body with base64 photos or
+           from a multipart form with the photos as files.
+        """
+        if request.mimetype == 'multipart/form-data':
+            body = request.form.to_dict()
+            validator = DOCTOR_APPLICATION_FORM_SCHEMA.validator
+            errors = {} if validator.validate(body) else validator.errors
+            errors.update({field: ['required field'] for field in PHOTO_FIELDS
+                           if not request.files.get(field)})
+            if errors:
+                return custom_response({'code': 'Valores ingresados inválidos',
+                                        'message': errors}, 400)
+            photos = {field: (request.files[field].stream,
+                              photo_content_type(request.files[field].mimetype))
+                      for field in PHOTO_FIELDS}
+        else:
+            try:
+                body = request.get_json()
+            except:
+                return custom_response({
+                    "code": "Bad JSON",
+                    "message": {
+                        "esp": "El JSON está mal construido",
+                        "eng": "JSON with invalid syntax"
+                    }}, 400)
+
+            validator = DOCTOR_APPLICATION_SCHEMA.validator
+
+            if not validator.validate(body):
+                return custom_response({'code': 'Valores ingresados inválidos',
+                                        'message':validator.errors}, 400)
+            photos = {}
+            for field in PHOTO_FIELDS:
+                content_type, data = decode_photo(body[field])
+                photos[field] = (io.BytesIO(data), content_type)
+
+        references = {}
         try:
-            body = request.get_json()
-        except:
+            for field, (stream, content_type) in photos.items():
+                references[field] = store_photo(db, stream, field, content_type,
+                                                max_size=MAX_PHOTO_BYTES)
+            body.update(references)
+            result = post_doctor_id(db, body)
+        except PhotoTooLarge as error:
+            delete_photos(db, references.values())
             return custom_response({
-                "code": "Bad JSON",
+                "code": "photo too large",
                 "message": {
-                    "esp": "El JSON está mal construido",
-                    "eng": "JSON with invalid syntax"
-                }}, 400)
-
-        email_regex = '(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)'
-        schema = {
-                    "first_name": {'type': 'string', 'required':True},
-                    "last_name": {'type': 'string','required':True},
-                    "cellphone": {'type': 'string','required':True, 'regex': '[0-9]{10}'},
-                    "email": {'type': 'string','required':True, 'regex':email_regex},
-                    "professional_card_photo": {'type': 'string','required':True},
-                    "official_id_photo": {'type': 'string','required':True}
-                }
-        validator = Validator(schema)
-
-        if not validator.validate(body):
-            return custom_response({'code': 'Valores ingresados inválidos',
-                                    'message':validator.errors}, 400)
+                    "esp": "la foto %s supera %d bytes" % (error, MAX_PHOTO_BYTES),
+                    "eng": "photo %s is larger than %d bytes" % (error, MAX_PHOTO_BYTES)
+                }}, 413)
+        except Exception:
+            delete_photos(db, references.values())
+            raise
 
-        result = post_doctor_id(db, body)
         if result['inserted']:
             return custom_response({
                 "code": "Solicitud realizada",
@@ -370,6 +850,35 @@ class Doctor(Resource):
                 }, 202)
 
 
+class DoctorPhoto(Resource):
+    @cross_origin(headers=["Content-Type", "Authorization", "Range"])
+    def get(self, file_id):
+        """Sends a photo of a doctor application. Photos never change, so
+           responses are cacheable and support byte ranges.
+        """
+        token_valid = auth_handler.get_payload(request)
+        if isinstance(token_valid, AuthError):
+            return custom_response(token_valid.error, token_valid.status_code)
+
+        photo = open_photo(db, file_id)
+        if photo is None:
+            return custom_response({
+                "code": "photo not found",
+                "message": {
+                    "esp": "foto no encontrada",
+                    "eng": "photo not found"
+                }}, 404)
+
+        response = Response(wrap_file(request.environ, photo),
+                            mimetype=photo.metadata['content_type'],
+                            direct_passthrough=True)
+        response.content_length = photo.length
+        response.headers.update(immutable_headers(file_id, photo.upload_date))
+        response.headers['X-Content-Type-Options'] = 'nosniff'
+        return response.make_conditional(request, accept_ranges=True,
+                                         complete_length=photo.length)
+
+
 class Report(Resource):
 
     @cross_origin(headers=["Content-Type", "Authorization"])
@@ -391,27 +900,14 @@ class Report(Resource):
                     "eng": "JSON"
                 }}, 400)
 
-        schema = {
-                    'report_id': {'type': 'string', 'required':True},
-                    'statuses': {
-                        'type' : 'list',
-                        'required' : True,
-                        'schema': {
-                            'type' : 'dict',
-                            'schema':{
-                                'name' : {'type': 'string', 'required': True},
-                                'active' : {'type': 'boolean', 'required': True}
-                            }
-                        }
-                    }
-                }
-        validator = Validator(schema)
+        validator = REPORT_SCHEMA.validator
 
         if not validator.validate(body):
             return custom_response({'code': 'invalid values',
                                     'message':validator.errors}, 400)
 
         result = create_replace_report(db, body)
+        report_cache.invalidate(body['report_id'])
 
         if result['operation'] == 'update':
 
@@ -448,7 +944,6 @@ class Report(Resource):
     def get(self):
         """Get report by id"""
 
-        parser = reqparse.RequestParser()
         token_valid = auth_handler.get_payload(request)
         if isinstance(token_valid, AuthError):
             return custom_response(token_valid.error, token_valid.status_code)
@@ -463,15 +958,41 @@ class Report(Resource):
                     "esp": "id del reporte requerido"
                 }}, 400)
 
-        report_info = get_report_id(db, report_id=args['report_id'])
+        fields = parse_fields(args.get('fields'))
+        # Each field selection is its own representation.
+        etag_parts = (args['report_id'],) if fields is None else (args['report_id'], fields)
 
-        return custom_response({"code": "report found", "message": report_info},
-                               200) if report_info else custom_response({
-                               "code": "report non existent",
-                               "message": {
-                                    "eng": "report doesn't exist",
-                                    "esp": "reporte no existe"
-                               }}, 404)
+        if request.if_none_match or request.if_modified_since:
+            last_update = report_cache.load(
+                ('report_last_update', args['report_id']),
+                lambda: get_report_last_update(db, report_id=args['report_id']))
+            if last_update:
+                etag = make_etag(last_update, *etag_parts)
+                if is_not_modified(request.headers, etag, last_update):
+                    return not_modified_response(etag, last_update)
+
+        try:
+            report_info = report_cache.load(
+                ('report', args['report_id'],
+                 None if fields is None else tuple(fields)),
+                lambda: get_report_id(db, report_id=args['report_id'],
+                                      fields=fields))
+        except InvalidFields as error:
+            return invalid_fields_response(error)
+
+        if not report_info:
+            return custom_response({
+                "code": "report non existent",
+                "message": {
+                    "eng": "report doesn't exist",
+                    "esp": "reporte no existe"
+                }}, 404)
+
+        response = custom_response({"code": "report found", "message": report_info}, 200)
+        last_update = report_info.get('_last_update')
+        if last_update:
+            set_validators(response, make_etag(last_update, *etag_parts), last_update)
+        return response
 
 class Feedback(Resource):
     def post(self):
@@ -485,16 +1006,26 @@ class Feedback(Resource):
                     "eng": "JSON with invalid syntax"
                 }}, 400)
 
-        schema = {
-            "feedback": {'type': 'string', 'required':True}
-        }
-        validator = Validator(schema)
+        validator = FEEDBACK_SCHEMA.validator
 
         if not validator.validate(body):
             return custom_response({'code': 'Valores ingresados inválidos',
                                     'message':validator.errors}, 400)
 
-        result = post_feedback(db, body)
+        if feedback_buffer is None:
+            result = post_feedback(db, body)
+        else:
+            try:
+                result = buffer_feedback(feedback_buffer, body)
+            except BufferFull:
+                response = custom_response({
+                    "code": "feedback buffer full",
+                    "message": {
+                        "esp": "demasiadas sugerencias, intente de nuevo",
+                        "eng": "too many feedback submissions, try again"
+                    }}, 503)
+                response.headers['Retry-After'] = '5'
+                return response
 
         if result['inserted']:
             return custom_response({
@@ -518,10 +1049,26 @@ class Feedback(Resource):
         if isinstance(token_valid, AuthError):
             return custom_response(token_valid.error, token_valid.status_code)
 
-        feedback_info = get_feedback(db)
+        limit, next_token, error = page_args(request.args)
+        if error:
+            return error
 
-        return custom_response({"code": "feedback found", "message": feedback_info},
-                               200) if feedback_info else custom_response({
+        try:
+            feedback_info, next_token = get_feedback(
+                db, limit=limit, next_token=next_token,
+                stream_batch_size=stream_args(request.args))
+        except InvalidPageToken:
+            return invalid_page_token_response()
+
+        if stream_args(request.args):
+            response = stream_response("feedback found", feedback_info,
+                                       limit, next_token)
+            if response:
+                return response
+            feedback_info = []
+
+        return page_response("feedback found", feedback_info, limit,
+                             next_token) if feedback_info else custom_response({
                                "code": "feedback non existent",
                                "message": {
                                     "eng": "feedback doesn't exist",
@@ -531,21 +1078,74 @@ class Feedback(Resource):
 
 class HealthCheck(Resource):
     def get(self):
-        try:
-            info = db_client.server_info()
-            return make_response(jsonify({"message": 'DB_OK'}))
-        except Exception:
-            print('Error in healthcheck')
-            print(traceback.format_exc())
-            print("Error: %s", sys.exc_info())
-            return "DB error"
+        ready, checks = health_prober.results()
+        mongo = checks['mongo']
+        return custom_response({"message": 'DB_OK' if mongo['ok'] else 'DB error',
+                                "checked_at": mongo['checked_at'],
+                                "error": mongo['error'],
+                                "pool": db_client.pool_stats()},
+                               200 if mongo['ok'] else 503)
+
+
+@app.route('/health/live')
+def liveness():
+    # The worker is able to answer, whatever the state of its dependencies.
+    return custom_response({"status": "alive"}, 200)
+
+
+@app.route('/health/ready')
+def readiness():
+    ready, checks = health_prober.results()
+    return custom_response({"status": "ready" if ready else "not ready",
+                            "checks": checks}, 200 if ready else 503)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 
 # Setup the Api resource routing here
 # Route the URL to the resource
 api.add_resource(Diagnostic, '/diagnostic')
+api.add_resource(DiagnosticBatch, '/diagnostic/batch')
 api.add_resource(HealthCheck, '/health-check')
 api.add_resource(Appointment, '/appointment')
 api.add_resource(Doctor, '/doctor')
+api.add_resource(DoctorPhoto, '/doctor/photo/<file_id>')
 api.add_resource(Report, '/report')
 api.add_resource(Feedback, '/feedback')
+
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    """Creates the registered indexes if they don't exist."""
+    click.echo(json.dumps(ensure_indexes(db), indent=2))
+
+
+@app.cli.command('remove-duplicates')
+@click.option('--dry-run', is_flag=True,
+              help="Only count the duplicates.")
+def remove_duplicates_command(dry_run):
+    """Merges duplicated diagnostics and reports so their unique indexes
+       can be created.
+    """
+    click.echo(json.dumps(remove_duplicates(db, dry_run=dry_run), indent=2))
+
+
+@app.cli.command('index-report')
+def index_report_command():
+    """Lists missing, unregistered and unused indexes."""
+    click.echo(json.dumps(index_report(db), indent=2))
+
+
+@app.cli.command('reconcile-summary')
+def reconcile_summary_command():
+    """Recounts the videocalls with consent accepted."""
+    click.echo(reconcile_summary(db))
+
+
+@app.cli.command('migrate-doctor-photos')
+def migrate_doctor_photos_command():
+    """Moves the photos stored in doctor documents to GridFS."""
+    click.echo(json.dumps(migrate_photos(db), indent=2))
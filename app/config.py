@@ -0,0 +1,81 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Environment Variables
+MONGO_URI = os.getenv('MONGO_URI')
+DB_NAME = os.getenv('DB_NAME')
+AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
+API_AUDIENCE = os.getenv('API_AUDIENCE')
+ALGORITHMS = os.getenv('ALGORITHMS')
+VIDEOCALL_CODE_SIZE = int(os.getenv('VIDEOCALL_CODE_SIZE'))
+AUTH0_JWKS_URL = os.getenv('AUTH0_JWKS_URL')
+JWKS_CACHE_TTL = int(os.getenv('JWKS_CACHE_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv('JWKS_MIN_REFRESH_INTERVAL', 30))
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 500))
+DEFAULT_PAGE_SIZE = min(int(os.getenv('DEFAULT_PAGE_SIZE', 100)), MAX_PAGE_SIZE)
+MAX_BATCH_PATIENTS = int(os.getenv('MAX_BATCH_PATIENTS', 500))
+DIAGNOSTIC_BATCH_MAX_SIZE = int(os.getenv('DIAGNOSTIC_BATCH_MAX_SIZE', 1000))
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 500))
+SUMMARY_CACHE_TTL = float(os.getenv('SUMMARY_CACHE_TTL', 10))
+SUMMARY_RECONCILE_INTERVAL = float(os.getenv('SUMMARY_RECONCILE_INTERVAL', 300))
+HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', 5))
+ENSURE_INDEXES = os.getenv('ENSURE_INDEXES', 'true').lower() in ('1', 'true', 'yes')
+JSON_PROVIDER = os.getenv('JSON_PROVIDER', 'auto')
+# Commands slower than this are logged; a negative value disables the log.
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 100))
+EXPLAIN_SLOW_QUERIES = os.getenv('EXPLAIN_SLOW_QUERIES', '').lower() in ('1', 'true', 'yes')
+# Response encodings in order of preference; br and zstd are skipped when
+# brotli or zstandard aren't installed, an empty list disables compression.
+COMPRESSION_ENCODINGS = [name.strip() for name in
+                         os.getenv('COMPRESSION_ENCODINGS', 'zstd,br,gzip').split(',')
+                         if name.strip()]
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_LEVELS = {
+    'gzip': int(os.getenv('GZIP_LEVEL', 6)),
+    'br': int(os.getenv('BROTLI_QUALITY', 4)),
+    'zstd': int(os.getenv('ZSTD_LEVEL', 3)),
+}
+# Time limit of reads, in ms, 0 disables it. Read-only lists prefer
+# secondaries at most MONGO_MAX_STALENESS_SECONDS behind, -1 for no bound.
+MONGO_MAX_TIME_MS = int(os.getenv('MONGO_MAX_TIME_MS', 10000))
+SECONDARY_READS = os.getenv('SECONDARY_READS', 'true').lower() in ('1', 'true', 'yes')
+MONGO_MAX_STALENESS_SECONDS = int(os.getenv('MONGO_MAX_STALENESS_SECONDS', 90))
+MONGO_WRITE_TIMEOUT_MS = int(os.getenv('MONGO_WRITE_TIMEOUT_MS', 5000))
+# Reports and their latest diagnostic are cached per worker, dropped by a
+# change stream or after REPORT_CACHE_TTL seconds; without change streams
+# they live REPORT_CACHE_FALLBACK_TTL seconds. A size of 0 disables it.
+REPORT_CACHE_SIZE = int(os.getenv('REPORT_CACHE_SIZE', 10000))
+REPORT_CACHE_TTL = float(os.getenv('REPORT_CACHE_TTL', 60))
+REPORT_CACHE_FALLBACK_TTL = float(os.getenv('REPORT_CACHE_FALLBACK_TTL', 1))
+MAX_PHOTO_BYTES = int(os.getenv('MAX_PHOTO_BYTES', 10 * 1024 * 1024))
+# Larger request bodies are refused before being read. The default fits a
+# doctor application with both photos base64 encoded.
+MAX_REQUEST_BYTES = int(os.getenv('MAX_REQUEST_BYTES', 3 * MAX_PHOTO_BYTES))
+# POST /feedback is buffered and written in batches when a journal directory
+# is set.
+FEEDBACK_BUFFER_DIR = os.getenv('FEEDBACK_BUFFER_DIR')
+FEEDBACK_BUFFER_SIZE = int(os.getenv('FEEDBACK_BUFFER_SIZE', 10000))
+FEEDBACK_FLUSH_SIZE = int(os.getenv('FEEDBACK_FLUSH_SIZE', 500))
+FEEDBACK_FLUSH_INTERVAL = float(os.getenv('FEEDBACK_FLUSH_INTERVAL', 1))
+
+
+def _optional_int(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+# MongoClient pool, timeout and compression settings; unset ones keep the
+# pymongo defaults.
+MONGO_CLIENT_OPTIONS = {name: value for name, value in {
+    'maxPoolSize': _optional_int('MONGO_MAX_POOL_SIZE'),
+    'minPoolSize': _optional_int('MONGO_MIN_POOL_SIZE'),
+    'waitQueueTimeoutMS': _optional_int('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+    'serverSelectionTimeoutMS': _optional_int('MONGO_SERVER_SELECTION_TIMEOUT_MS'),
+    'connectTimeoutMS': _optional_int('MONGO_CONNECT_TIMEOUT_MS'),
+    'socketTimeoutMS': _optional_int('MONGO_SOCKET_TIMEOUT_MS'),
+    'compressors': os.getenv('MONGO_COMPRESSORS'),
+}.items() if value is not None}
@@ -0,0 +1,201 @@
+import logging
+import pymongo
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Indexes every collection is expected to have, keyed by collection name.
+# Each compound index follows the equality filter and then the sort used by
+# the matching db_queries_* function (date, then _id for keyset pagination),
+# so the sort and the page ranges are read from the index.
+INDEXES = {
+    'appointment': [
+        IndexModel([('videocall_code', pymongo.ASCENDING)],
+                   name='videocall_code_unique', unique=True),
+        IndexModel([('patient_id', pymongo.ASCENDING),
+                    ('_appointment_creation_date', pymongo.DESCENDING),
+                    ('_id', pymongo.DESCENDING)],
+                   name='patient_id_creation_date_id'),
+        IndexModel([('doctor_id', pymongo.ASCENDING),
+                    ('_appointment_creation_date', pymongo.DESCENDING),
+                    ('_id', pymongo.DESCENDING)],
+                   name='doctor_id_creation_date_id'),
+        IndexModel([('informed_consent_accepted', pymongo.ASCENDING)],
+                   name='informed_consent_accepted'),
+    ],
+    'diagnostic': [
+        IndexModel([('report_id', pymongo.ASCENDING),
+                    ('patient_id', pymongo.ASCENDING),
+                    ('doctor_id', pymongo.ASCENDING)],
+                   name='report_id_patient_id_doctor_id_unique', unique=True),
+        IndexModel([('patient_id', pymongo.ASCENDING),
+                    ('_diagnostic_date', pymongo.DESCENDING),
+                    ('_id', pymongo.DESCENDING)],
+                   name='patient_id_diagnostic_date_id'),
+        IndexModel([('doctor_id', pymongo.ASCENDING),
+                    ('_diagnostic_date', pymongo.DESCENDING),
+                    ('_id', pymongo.DESCENDING)],
+                   name='doctor_id_diagnostic_date_id'),
+        IndexModel([('report_id', pymongo.ASCENDING),
+                    ('_diagnostic_date', pymongo.DESCENDING),
+                    ('_id', pymongo.DESCENDING)],
+                   name='report_id_diagnostic_date_id'),
+    ],
+    'doctor': [
+        IndexModel([('registered', pymongo.ASCENDING),
+                    ('_request_date', pymongo.DESCENDING),
+                    ('_id', pymongo.DESCENDING)],
+                   name='registered_request_date_id'),
+        IndexModel([('cellphone', pymongo.ASCENDING),
+                    ('email', pymongo.ASCENDING)],
+                   name='cellphone_email'),
+    ],
+    'report': [
+        IndexModel([('report_id', pymongo.ASCENDING)],
+                   name='report_id_unique', unique=True),
+    ],
+    'feedback': [
+        IndexModel([('_feedback_date', pymongo.DESCENDING),
+                    ('_id', pymongo.DESCENDING)],
+                   name='feedback_date_id'),
+    ],
+}
+
+
+# Unique indexes whose duplicates remove_duplicates merges: the document
+# updated last is kept, with the earliest creation date of its duplicates.
+# Duplicated videocall codes are different appointments and are left to be
+# fixed by hand.
+DEDUPLICATED = {
+    'diagnostic': ('report_id_patient_id_doctor_id_unique', '_last_update',
+                   '_diagnostic_date'),
+    'report': ('report_id_unique', '_last_update', '_report_creation_date'),
+}
+
+
+class MissingIndexError(Exception):
+    """A unique index a write relies on doesn't exist."""
+
+
+# (collection, index) pairs already found, checked once per process.
+_unique_indexes_found = set()
+
+
+def require_unique_index(collection, name):
+    """Raises MissingIndexError unless ``collection`` has the unique index
+       ``name``, so writes that rely on it for correctness are refused
+       instead of silently creating duplicates.
+    """
+    key = (collection.full_name, name)
+    if key in _unique_indexes_found:
+        return
+    index = collection.index_information().get(name)
+    if not index or not index.get('unique'):
+        logger.error("Unique index %s on %s is missing, run flask "
+                     "ensure-indexes", name, collection.full_name)
+        raise MissingIndexError("Unique index %s on %s doesn't exist"
+                                % (name, collection.full_name))
+    _unique_indexes_found.add(key)
+
+
+def ensure_indexes(db, indexes=INDEXES, strict=False):
+    """Creates the registered indexes. Indexes that already exist with the
+       same definition are left untouched, so it is safe to run it on every
+       start. Returns the names created or confirmed and the errors found per
+       collection.
+
+       With ``strict``, MissingIndexError is raised after trying them all if
+       a unique index couldn't be created, usually because of duplicates.
+    """
+    result = {}
+    failed_unique = []
+    for collection, models in indexes.items():
+        ensured, errors = [], []
+        for model in models:
+            try:
+                ensured.extend(db[collection].create_indexes([model]))
+            except OperationFailure as error:
+                logger.error("Index %s on %s couldn't be created: %s",
+                             model.document['name'], collection, error)
+                errors.append({'index': model.document['name'],
+                               'error': str(error)})
+                if model.document.get('unique'):
+                    failed_unique.append('%s.%s' % (collection,
+                                                    model.document['name']))
+        result[collection] = {'ensured': ensured, 'errors': errors}
+
+    if strict and failed_unique:
+        raise MissingIndexError(
+            "Unique indexes %s couldn't be created, remove the duplicates "
+            "with ENSURE_INDEXES=0 flask remove-duplicates"
+            % ', '.join(failed_unique))
+
+    return result
+
+
+def remove_duplicates(db, dry_run=False):
+    """Merges the documents that keep the unique indexes in DEDUPLICATED
+       from being created. Returns the number of duplicated keys and of
+       documents removed per collection; with ``dry_run`` nothing changes.
+    """
+    result = {}
+    for collection, (index, updated, created) in DEDUPLICATED.items():
+        model = next(model for model in INDEXES[collection]
+                     if model.document['name'] == index)
+        duplicates = db[collection].aggregate([
+            {'$sort': {updated: pymongo.DESCENDING, '_id': pymongo.DESCENDING}},
+            {'$group': {'_id': {key: '$' + key for key in model.document['key']},
+                        'ids': {'$push': '$_id'},
+                        'created': {'$min': '$' + created},
+                        'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}}
+        ], allowDiskUse=True)
+
+        keys, removed = 0, 0
+        for duplicate in duplicates:
+            kept, extra = duplicate['ids'][0], duplicate['ids'][1:]
+            keys += 1
+            removed += len(extra)
+            if dry_run:
+                continue
+            db[collection].delete_many({'_id': {'$in': extra}})
+            if duplicate['created'] is not None:
+                db[collection].update_one(
+                    {'_id': kept}, {'$set': {created: duplicate['created']}})
+        if keys:
+            logger.warning("%s duplicated keys of %s on %s, %s documents %s",
+                           keys, index, collection, removed,
+                           'to remove' if dry_run else 'removed')
+        result[collection] = {'duplicated_keys': keys, 'removed': removed}
+
+    return result
+
+
+def index_report(db, indexes=INDEXES):
+    """Compares the indexes in the database with the registry.
+
+       For each collection returns the registered indexes that are missing,
+       the indexes present but not registered and the ones that haven't been
+       used since the server started (according to $indexStats).
+    """
+    report = {}
+    for collection, models in indexes.items():
+        expected = {model.document['name'] for model in models}
+        existing = set(db[collection].index_information()) - {'_id_'}
+
+        try:
+            stats = db[collection].aggregate([{'$indexStats': {}}])
+            unused = sorted(stat['name'] for stat in stats
+                            if stat['name'] != '_id_'
+                            and not stat['accesses']['ops'])
+        except OperationFailure:
+            unused = None
+
+        report[collection] = {
+            'missing': sorted(expected - existing),
+            'unregistered': sorted(existing - expected),
+            'unused': unused
+        }
+
+    return report
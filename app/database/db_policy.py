@@ -0,0 +1,129 @@
+"""Read preference, read concern, write concern and time limit of the query
+functions.
+
+Each db_queries function declares its policy with the ``query_policy``
+decorator; functions without one keep the defaults of the client.
+``PolicyDatabase`` hands the function running its collections with the
+options of that policy, so the queries themselves don't change.
+"""
+import contextvars
+import functools
+from collections import namedtuple
+
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import SecondaryPreferred
+from pymongo.write_concern import WriteConcern
+
+QueryPolicy = namedtuple('QueryPolicy', 'read_preference read_concern '
+                                        'write_concern max_time_ms')
+
+_current_policy = contextvars.ContextVar('query_policy', default=None)
+
+
+def query_policy(name):
+    """Applies the policy ``name`` to the collections the decorated query
+       function gets from a PolicyDatabase while it runs.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            token = _current_policy.set(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _current_policy.reset(token)
+        return wrapper
+    return decorator
+
+
+def query_policies(max_time_ms=None, secondary_reads=True, max_staleness=-1,
+                   write_timeout_ms=None):
+    """Returns the QueryPolicy of each policy name.
+
+       Reads and the commands of writes that read (counts, find-and-modify)
+       are bounded by ``max_time_ms``. Secondary reads go to a secondary at
+       most ``max_staleness`` seconds behind when ``secondary_reads``, and to
+       the primary otherwise. Majority writes wait ``write_timeout_ms`` at
+       most for the acknowledgement.
+    """
+    return {
+        # Reads a client usually makes right after its own write.
+        'primary_read': QueryPolicy(None, None, None, max_time_ms),
+        # Lists and counters that can lag the primary by a few seconds.
+        'secondary_read': QueryPolicy(
+            SecondaryPreferred(max_staleness=max_staleness)
+            if secondary_reads else None,
+            ReadConcern('local'), None, max_time_ms),
+        # Writes cheap to lose, like feedback.
+        'acknowledged_write': QueryPolicy(None, None, WriteConcern(w=1),
+                                          max_time_ms),
+        # Writes that must survive a failover.
+        'majority_write': QueryPolicy(
+            None, None, WriteConcern('majority', wtimeout=write_timeout_ms),
+            max_time_ms),
+    }
+
+
+class PolicyCollection:
+    """Collection adding the maxTimeMS of a policy to the commands that read."""
+
+    TIME_LIMIT_OPTIONS = {
+        'find': 'max_time_ms',
+        'find_one': 'max_time_ms',
+        'aggregate': 'maxTimeMS',
+        'count_documents': 'maxTimeMS',
+        'distinct': 'maxTimeMS',
+        'find_one_and_update': 'maxTimeMS',
+        'find_one_and_replace': 'maxTimeMS',
+        'find_one_and_delete': 'maxTimeMS',
+    }
+
+    def __init__(self, collection, max_time_ms):
+        self.collection = collection
+        self.max_time_ms = max_time_ms
+
+    def __getattr__(self, name):
+        attribute = getattr(self.collection, name)
+        option = self.TIME_LIMIT_OPTIONS.get(name)
+        if option is None:
+            return attribute
+
+        def limited(*args, **kwargs):
+            kwargs.setdefault(option, self.max_time_ms)
+            return attribute(*args, **kwargs)
+        return limited
+
+
+class PolicyDatabase:
+    """Database handle whose collections follow the ``query_policy`` of the
+       query function running. Outside of one, or for functions without a
+       policy, they are the plain collections.
+    """
+
+    def __init__(self, database, policies):
+        self.database = database
+        self.policies = policies
+
+    @property
+    def policy(self):
+        """The QueryPolicy of the query function running, or None."""
+        return self.policies.get(_current_policy.get())
+
+    def __getitem__(self, name):
+        collection = self.database[name]
+        policy = self.policy
+        if policy is None:
+            return collection
+
+        options = {option: value for option, value in (
+            ('read_preference', policy.read_preference),
+            ('read_concern', policy.read_concern),
+            ('write_concern', policy.write_concern)) if value is not None}
+        if options:
+            collection = collection.with_options(**options)
+        if policy.max_time_ms:
+            collection = PolicyCollection(collection, policy.max_time_ms)
+        return collection
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
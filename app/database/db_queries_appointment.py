@@ -1,35 +1,132 @@
 import datetime as dt
+import logging
+import threading
+import time
+from collections import deque
 import pymongo
 import random
 import string
+from pymongo.errors import DuplicateKeyError
 
+from app.database.db_indexes import require_unique_index
+from app.database.db_policy import query_policy
+from app.database.pagination import find_page
+from app.database.projection import select_fields
+from app.helpers import metrics
+from app.helpers.metrics import instrumented_query
 
+logger = logging.getLogger(__name__)
+
+MAX_VIDEOCALL_CODE_ATTEMPTS = 20
+VIDEOCALL_CODE_OCCUPANCY_WARNING = 0.5
+SUMMARY_COUNTER = 'accepted_consent_videocalls'
+APPOINTMENT_PROJECTION = {
+    'patient_id': 1,
+    'doctor_id': 1 ,
+    'videocall_code': 1,
+    'informed_consent_accepted': 1,
+    '_appointment_creation_date': 1,
+    '_id': 0
+}
+
+
+class VideocallCodeStats:
+    """Counts videocall code allocations and collisions in this process.
+
+       With codes drawn uniformly, the fraction of attempts that collide
+       estimates how full the code space is.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.attempts = 0
+        self.collisions = 0
+        self._recent = deque(maxlen=window)
+        self._recent_collisions = 0
+        self._warned = False
+        self._lock = threading.Lock()
+
+    def record(self, collided):
+        with self._lock:
+            self.attempts += 1
+            self.collisions += collided
+            if len(self._recent) == self.window:
+                self._recent_collisions -= self._recent[0]
+            self._recent.append(collided)
+            self._recent_collisions += collided
+            occupancy = self.occupancy()
+            crossed = occupancy >= VIDEOCALL_CODE_OCCUPANCY_WARNING
+            warn = crossed and not self._warned
+            self._warned = crossed
+
+        metrics.VIDEOCALL_CODE_ATTEMPTS.inc('taken' if collided else 'free')
+        metrics.VIDEOCALL_CODE_OCCUPANCY.set(occupancy)
+
+        if warn:
+            logger.warning("Videocall code space is about %.0f%% used, "
+                           "increase VIDEOCALL_CODE_SIZE", occupancy * 100)
+
+    def occupancy(self):
+        if not self._recent:
+            return 0.0
+        return self._recent_collisions / len(self._recent)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'attempts': self.attempts,
+                'collisions': self.collisions,
+                'collision_rate': (self.collisions / self.attempts
+                                   if self.attempts else 0.0),
+                'estimated_occupancy': self.occupancy()
+            }
+
+
+videocall_code_stats = VideocallCodeStats()
+
+
+@instrumented_query
+@query_policy('majority_write')
 def post_appointment(db, appointment_info, videocall_code_size):
     """ Creates an apointment with user info and consent in false if is not
-        present in appointment_info
+        present in appointment_info.
+        The videocall code is drawn at random and the insert is retried
+        when the unique index on videocall_code reports it is taken, so
+        MissingIndexError is raised if that index doesn't exist.
     """
+    require_unique_index(db['appointment'], 'videocall_code_unique')
     appointment_info['_appointment_creation_date'] = dt.datetime.utcnow()
-
-    while True:
-        videocall_code_rand = ''.join(
-            random.choices(string.digits, k=videocall_code_size))
-        if  not db['appointment'].find_one(
-                {'videocall_code' : videocall_code_rand}):
-            break
-
-    appointment_info['videocall_code'] = videocall_code_rand
     appointment_info['informed_consent_accepted'] = (
         False if not appointment_info['informed_consent_accepted'] else True)
 
-    inserted = db['appointment'].insert_one(appointment_info)
+    for _ in range(MAX_VIDEOCALL_CODE_ATTEMPTS):
+        videocall_code_rand = ''.join(
+            random.choices(string.digits, k=videocall_code_size))
+        appointment_info['videocall_code'] = videocall_code_rand
+        appointment_info.pop('_id', None)
+        try:
+            inserted = db['appointment'].insert_one(appointment_info)
+        except DuplicateKeyError:
+            videocall_code_stats.record(True)
+            continue
+        videocall_code_stats.record(False)
+        if appointment_info['informed_consent_accepted']:
+            _increment_summary(db, 1)
+        break
+    else:
+        logger.error("No free videocall code after %s attempts",
+                     MAX_VIDEOCALL_CODE_ATTEMPTS)
+        return False, appointment_info['_appointment_creation_date'], None
 
     return inserted.acknowledged, appointment_info[
         '_appointment_creation_date'], videocall_code_rand
 
 
+@instrumented_query
+@query_policy('majority_write')
 def modify_appointment(db, consent, videocall_code):
     """Modify informed consent by videocall_code"""
-    result = db['appointment'].update(
+    previous = db['appointment'].find_one_and_update(
         {
             'videocall_code': videocall_code
         },
@@ -38,31 +135,121 @@ def modify_appointment(db, consent, videocall_code):
                 'informed_consent_accepted' : consent
             }
         },
-        upsert=False
+        projection={'informed_consent_accepted': 1, '_id': 0},
+        return_document=pymongo.ReturnDocument.BEFORE
     )
 
-    return result['n'], result['nModified']
+    if previous is None:
+        return 0, 0
 
-def get_appointment(db, patient_id=None, doctor_id=None):
-    """gets a patient by id"""
+    was_accepted = previous.get('informed_consent_accepted') is True
+    if was_accepted != (consent is True):
+        _increment_summary(db, 1 if consent is True else -1)
+
+    return 1, int(previous.get('informed_consent_accepted') != consent)
+
+@instrumented_query
+@query_policy('primary_read')
+def get_appointment(db, patient_id=None, doctor_id=None, limit=None,
+                    next_token=None, stream_batch_size=None, fields=None):
+    """gets the appointments of a patient or doctor, newest first.
+       Returns the appointments (a cursor when streaming) and the token of
+       the next page.
+    """
     query = {}
     if patient_id:
         query['patient_id'] = patient_id
     if doctor_id:
         query['doctor_id'] = doctor_id
 
-    appointment_info = db['appointment'].find(query, {
-            'patient_id': 1,
-            'doctor_id': 1 ,
-            'videocall_code': 1,
-            'informed_consent_accepted': 1,
-            '_appointment_creation_date': 1,
-            '_id': 0
-        }).sort([("_appointment_creation_date", pymongo.DESCENDING),
-                 ("patient_id", pymongo.DESCENDING)])
-    return list(appointment_info)
-
-def get_summary(db):
-    """get the amount of videcalls with consent accepted."""
-    summary = db['appointment'].count({"informed_consent_accepted": True})
+    return find_page(db['appointment'], query,
+                     select_fields(APPOINTMENT_PROJECTION, fields),
+                     '_appointment_creation_date', limit=limit,
+                     next_token=next_token,
+                     stream_batch_size=stream_batch_size)
+
+def _increment_summary(db, amount):
+    """Keeps the accepted consent counter in step with the appointments. The
+       counter is only created by reconcile_summary so it never starts from a
+       partial count.
+    """
+    db['counters'].update_one({'_id': SUMMARY_COUNTER},
+                              {'$inc': {'value': amount}})
+
+
+@instrumented_query
+@query_policy('majority_write')
+def reconcile_summary(db, attempts=3):
+    """Recounts the videocalls with consent accepted and corrects the
+       counter if it drifted. The drift is only applied, as an $inc, if the
+       counter didn't move during the count, so increments made meanwhile
+       aren't overwritten; after ``attempts`` counts racing with writes the
+       counter is left for the next reconciliation.
+    """
+    for _ in range(attempts):
+        counter = db['counters'].find_one({'_id': SUMMARY_COUNTER})
+        summary = db['appointment'].count_documents(
+            {"informed_consent_accepted": True})
+        now = dt.datetime.utcnow()
+
+        if counter is None:
+            try:
+                db['counters'].insert_one({'_id': SUMMARY_COUNTER,
+                                           'value': summary,
+                                           '_last_reconciliation': now})
+            except DuplicateKeyError:
+                # Another worker created it during the count.
+                continue
+            return summary
+
+        drift = summary - counter['value']
+        corrected = db['counters'].update_one(
+            {'_id': SUMMARY_COUNTER, 'value': counter['value']},
+            {'$inc': {'value': drift}, '$set': {'_last_reconciliation': now}})
+        if corrected.matched_count:
+            if drift:
+                logger.warning("Accepted consent counter drifted from %s to %s",
+                               counter['value'], summary)
+            return summary
+
+    logger.info("Accepted consent counter kept changing during %s recounts, "
+                "left as is", attempts)
+    return summary
+
+
+@instrumented_query
+@query_policy('majority_write')
+def claim_summary_reconciliation(db, interval):
+    """Takes the lease to reconcile the summary for the next ``interval``
+       seconds, so one worker recounts at a time. Returns False if another
+       worker holds it.
+    """
+    now = dt.datetime.utcnow()
+    try:
+        db['locks'].update_one(
+            {'_id': SUMMARY_COUNTER, 'until': {'$lte': now}},
+            {'$set': {'until': now + dt.timedelta(seconds=interval)}},
+            upsert=True)
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+_summary_cache = {}
+
+
+@instrumented_query
+@query_policy('secondary_read')
+def get_summary(db, cache_ttl=0):
+    """get the amount of videcalls with consent accepted, read from the
+       maintained counter and cached for ``cache_ttl`` seconds.
+    """
+    now = time.monotonic()
+    cached = _summary_cache.get(db.name)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    counter = db['counters'].find_one({'_id': SUMMARY_COUNTER})
+    summary = counter['value'] if counter else reconcile_summary(db)
+    _summary_cache[db.name] = (now + cache_ttl, summary)
     return summary
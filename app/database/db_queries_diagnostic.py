@@ -1,9 +1,24 @@
 import datetime as dt
 import pymongo
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 
+from app.database.db_policy import query_policy
+from app.database.pagination import find_page
+from app.database.projection import select_fields
+from app.helpers.metrics import instrumented_query
 
-def get_patient_id(db, patient_id=None, doctor_id=None, report_id=None, last_conduct=False):
-    """gets a patient by id"""
+DIAGNOSTIC_PROJECTION = {
+    'patient_id': 1,
+    'doctor_id': 1 ,
+    'diagnose': 1,
+    'report_id': 1,
+    'risk': 1,
+    '_diagnostic_date': 1,
+    'conduct': 1,
+    '_id': 0
+}
+
+def _diagnostic_query(patient_id=None, doctor_id=None, report_id=None):
     query = {}
     if patient_id:
         query['patient_id'] = patient_id
@@ -12,59 +27,184 @@ def get_patient_id(db, patient_id=None, doctor_id=None, report_id=None, last_con
     if report_id:
         query['report_id'] = report_id
 
-    patient_info = db['diagnostic'].find(query, {
-            'patient_id': 1,
-            'doctor_id': 1 ,
-            'diagnose': 1,
-            'report_id': 1,
-            'risk': 1,
-            '_diagnostic_date': 1,
-            'conduct': 1,
-            '_id': 0
-        }).sort([("_diagnostic_date", pymongo.DESCENDING),
-                 ("patient_id", pymongo.DESCENDING)])
+    return query
+
+@instrumented_query
+@query_policy('primary_read')
+def get_patient_id(db, patient_id=None, doctor_id=None, report_id=None, last_conduct=False,
+                   limit=None, next_token=None, stream_batch_size=None,
+                   fields=None, with_last_update=False):
+    """gets the diagnostics of a patient, doctor or report, newest first.
+       Returns the diagnostics (a cursor when streaming) and the token of
+       the next page. ``with_last_update`` adds their _last_update.
+    """
+    query = _diagnostic_query(patient_id, doctor_id, report_id)
+    projection = select_fields(DIAGNOSTIC_PROJECTION, fields)
+    if with_last_update:
+        projection = dict(projection, _last_update=1)
+
+    if last_conduct:
+        limit, next_token = 1, None
+
+    patient_info, next_token = find_page(
+        db['diagnostic'], query, projection, '_diagnostic_date',
+        limit=limit, next_token=next_token,
+        stream_batch_size=stream_batch_size)
 
     if last_conduct:
-        patient_info = [patient_info[0]] if patient_info.count() else []
+        next_token = None
 
-    return list(patient_info)
+    return patient_info, next_token
 
+@instrumented_query
+@query_policy('primary_read')
+def get_diagnostics_version(db, patient_id=None, doctor_id=None, report_id=None,
+                            last_conduct=False):
+    """gets the latest _last_update and the number of the diagnostics
+       matching the parameters (only the newest with ``last_conduct``),
+       without fetching them to the client.
+    """
+    pipeline = [{'$match': _diagnostic_query(patient_id, doctor_id, report_id)}]
+    if last_conduct:
+        pipeline += [
+            {'$sort': {'_diagnostic_date': pymongo.DESCENDING,
+                       '_id': pymongo.DESCENDING}},
+            {'$limit': 1}
+        ]
+    pipeline.append({'$group': {'_id': None,
+                                'last_update': {'$max': '$_last_update'},
+                                'count': {'$sum': 1}}})
+    versions = list(db['diagnostic'].aggregate(pipeline))
+
+    if not versions:
+        return None, 0
+    return versions[0]['last_update'], versions[0]['count']
+
+@instrumented_query
+@query_policy('primary_read')
+def get_last_conducts(db, patient_ids, fields=None):
+    """gets the most recent diagnostic of each patient in patient_ids with
+       one aggregation. The sort matches the patient_id/_diagnostic_date
+       index, so each group's first document is read from it.
+    """
+    projection = select_fields(DIAGNOSTIC_PROJECTION, fields)
+    last_conducts = db['diagnostic'].aggregate([
+        {'$match': {'patient_id': {'$in': list(patient_ids)}}},
+        {'$sort': {'patient_id': pymongo.ASCENDING,
+                   '_diagnostic_date': pymongo.DESCENDING,
+                   '_id': pymongo.DESCENDING}},
+        {'$group': {'_id': '$patient_id', 'diagnostic': {'$first': '$$ROOT'}}},
+        {'$replaceRoot': {'newRoot': '$diagnostic'}},
+        {'$sort': {'patient_id': pymongo.ASCENDING}},
+        {'$project': projection}
+    ])
+
+    return list(last_conducts)
+
+def _diagnostic_upsert(patient_info, now):
+    """Returns the filter and update that create or update a diagnostic."""
+    diagnostic_key = {
+        'report_id': patient_info['report_id'],
+        'patient_id': patient_info['patient_id'],
+        'doctor_id': patient_info['doctor_id']
+    }
+    changes = {
+        '$set' : {
+            'conduct' : patient_info['conduct'],
+            'diagnose' : patient_info['diagnose'],
+            'risk': patient_info.get('risk'),
+            '_last_update':  now
+        },
+        '$setOnInsert': {
+            '_diagnostic_date': now
+        }
+    }
+
+    return diagnostic_key, changes
+
+@instrumented_query
+@query_policy('majority_write')
 def post_patient_id(patient_info, db):
     """creates a new patient  with patient info or updates
-       if the patient already exists.
+       if the patient already exists, in a single upsert.
     """
+    now = dt.datetime.utcnow()
+    diagnostic_key, changes = _diagnostic_upsert(patient_info, now)
 
-    if db['diagnostic'].find_one({'report_id': patient_info[
-            'report_id'], 'patient_id': patient_info[
-            'patient_id'], 'doctor_id': patient_info['doctor_id']}):
-        result = db['diagnostic'].update(
-            {
-                'report_id': patient_info['report_id'],
-                'patient_id': patient_info['patient_id'],
-                'doctor_id': patient_info['doctor_id']
-            },
-            {
-                '$set' : {
-                    'conduct' : patient_info['conduct'],
-                    'diagnose' : patient_info['diagnose'],
-                    'risk': patient_info['risk'],
-                    '_last_update':  dt.datetime.utcnow()
-                }
-            }
-        )
+    try:
+        result = db['diagnostic'].update_one(diagnostic_key, changes,
+                                             upsert=True)
+    except DuplicateKeyError:
+        # A concurrent PUT inserted the same diagnostic first.
+        result = db['diagnostic'].update_one(diagnostic_key, changes)
 
+    if result.upserted_id is not None:
         return {
-            'operation': 'update',
-            'n_matched': result['n'],
-            'modified': result['nModified']
+            'operation': 'insert',
+            'inserted': result.acknowledged,
+            '_diagnostic_date': now
         }
 
-    patient_info['_diagnostic_date'] = dt.datetime.utcnow()
-    patient_info['_last_update'] = patient_info['_diagnostic_date']
-    inserted = db['diagnostic'].insert_one(patient_info)
-
     return {
-        'operation': 'insert',
-        'inserted': inserted.acknowledged,
-        '_diagnostic_date': patient_info['_diagnostic_date']
+        'operation': 'update',
+        'n_matched': result.matched_count,
+        'modified': result.modified_count
     }
+
+def _bulk_upsert(collection, operations):
+    """Runs the operations unordered. Returns the bulk result counters and
+       the write errors by operation index.
+    """
+    try:
+        result = collection.bulk_write(operations, ordered=False).bulk_api_result
+    except BulkWriteError as error:
+        result = error.details
+
+    return result, {write_error['index']: write_error
+                    for write_error in result.get('writeErrors', [])}
+
+def _diagnostic_statuses(n_diagnostics, errors, inserted, now):
+    """Builds the status of each diagnostic of a bulk write. Every upsert
+       that neither inserted nor failed matched its diagnostic.
+    """
+    statuses = []
+    for index in range(n_diagnostics):
+        if index in errors:
+            statuses.append({'index': index, 'status': 'error',
+                             'error': errors[index].get('errmsg')})
+        elif index in inserted:
+            statuses.append({'index': index, 'status': 'inserted',
+                             '_diagnostic_date': now})
+        else:
+            statuses.append({'index': index, 'status': 'updated'})
+
+    return statuses
+
+@instrumented_query
+@query_policy('majority_write')
+def post_diagnostics(db, diagnostics):
+    """creates or updates many diagnostics with one unordered bulk write.
+       Returns the status of each diagnostic, in the same order: inserted,
+       updated or error.
+    """
+    now = dt.datetime.utcnow()
+    upserts = [_diagnostic_upsert(patient_info, now)
+               for patient_info in diagnostics]
+    result, errors = _bulk_upsert(db['diagnostic'], [
+        pymongo.UpdateOne(diagnostic_key, changes, upsert=True)
+        for diagnostic_key, changes in upserts])
+    inserted = {upserted['index'] for upserted in result.get('upserted', [])}
+
+    # Upserts that lost a race against a concurrent insert of the same
+    # diagnostic are applied again, one by one so each gets its own result.
+    retries = [index for index, error in errors.items() if error['code'] == 11000]
+    for index in retries:
+        try:
+            retried = db['diagnostic'].update_one(*upserts[index])
+        except OperationFailure as error:
+            errors[index] = {'errmsg': str(error)}
+            continue
+        if retried.matched_count:
+            del errors[index]
+
+    return _diagnostic_statuses(len(diagnostics), errors, inserted, now)
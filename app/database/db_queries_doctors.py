@@ -1,6 +1,35 @@
 import datetime as dt
-import pymongo
+import io
+from bson import ObjectId
+from bson.errors import InvalidId
+from gridfs import GridFSBucket
+from gridfs.errors import NoFile
 
+from app.database.db_policy import PolicyDatabase, query_policy
+from app.database.db_setup import LazyDatabase
+from app.database.pagination import find_page
+from app.database.projection import select_fields
+from app.helpers.metrics import instrumented_query
+from app.helpers.photos import decode_photo
+
+PHOTO_BUCKET = 'doctor_photos'
+PHOTO_FIELDS = ('professional_card_photo', 'official_id_photo')
+PHOTO_CHUNK_SIZE = 255 * 1024
+
+DOCTOR_APPLICATION_PROJECTION = {
+    'first_name': 1,
+    'last_name': 1 ,
+    'cellphone': 1,
+    'email': 1,
+    'professional_card_photo': 1,
+    'conduct': 1,
+    'official_id_photo': 1,
+    '_request_date':1,
+    '_id':0
+}
+
+@instrumented_query
+@query_policy('majority_write')
 def post_doctor_id(db, doctor_info):
     """creates a new doctor with doctor info or updates
        if the doctor already exists.
@@ -15,6 +44,8 @@ def post_doctor_id(db, doctor_info):
         '_request_date': doctor_info['_request_date']
     }
 
+@instrumented_query
+@query_policy('majority_write')
 def modify_doctor(db, cellphone, email, registered):
     result = db['doctor'].update(
         {
@@ -36,20 +67,106 @@ def modify_doctor(db, cellphone, email, registered):
         'n_modified' : result['nModified']
     }
 
-def get_doctor_application(db):
-    """gets a doctor application by email"""
+@instrumented_query
+@query_policy('secondary_read')
+def get_doctor_application(db, limit=None, next_token=None, fields=None):
+    """gets the pending doctor applications, newest first.
+       Returns the applications and the token of the next page.
+    """
     query = {'registered' : False}
 
-    doctor_application = db['doctor'].find(query, {
-            'first_name': 1,
-            'last_name': 1 ,
-            'cellphone': 1,
-            'email': 1,
-            'professional_card_photo': 1,
-            'conduct': 1,
-            'official_id_photo': 1,
-            '_request_date':1,
-            '_id':0
-        }).sort([("_request_date", pymongo.DESCENDING)])
-
-    return list(doctor_application)
+    return find_page(db['doctor'], query,
+                     select_fields(DOCTOR_APPLICATION_PROJECTION, fields),
+                     '_request_date', limit=limit, next_token=next_token)
+
+
+class PhotoTooLarge(Exception):
+    """Raised when a photo is larger than the allowed size."""
+
+
+def _photo_bucket(db):
+    """GridFS only takes a plain Database, so the bucket gets the write
+       concern and read preference of the running policy itself.
+    """
+    options = {}
+    if isinstance(db, PolicyDatabase):
+        if db.policy is not None:
+            options = {'write_concern': db.policy.write_concern,
+                       'read_preference': db.policy.read_preference}
+        db = db.database
+    if isinstance(db, LazyDatabase):
+        db = db.database
+    return GridFSBucket(db, bucket_name=PHOTO_BUCKET, **options)
+
+@instrumented_query
+@query_policy('majority_write')
+def store_photo(db, stream, filename, content_type, max_size=None):
+    """streams a photo from a file-like object into GridFS.
+       Returns the reference kept in the doctor document.
+    """
+    grid_in = _photo_bucket(db).open_upload_stream(
+        filename, chunk_size_bytes=PHOTO_CHUNK_SIZE,
+        metadata={'content_type': content_type})
+    length = 0
+    try:
+        while True:
+            chunk = stream.read(PHOTO_CHUNK_SIZE)
+            if not chunk:
+                break
+            length += len(chunk)
+            if max_size is not None and length > max_size:
+                raise PhotoTooLarge(filename)
+            grid_in.write(chunk)
+    except BaseException:
+        grid_in.abort()
+        raise
+    grid_in.close()
+
+    return {
+        'file_id': grid_in._id,
+        'content_type': content_type,
+        'length': length
+    }
+
+@instrumented_query
+@query_policy('primary_read')
+def open_photo(db, file_id):
+    """returns a readable, seekable GridOut of the photo or None"""
+    try:
+        return _photo_bucket(db).open_download_stream(ObjectId(file_id))
+    except (InvalidId, TypeError, NoFile):
+        return None
+
+@instrumented_query
+@query_policy('majority_write')
+def delete_photos(db, references):
+    bucket = _photo_bucket(db)
+    for reference in references:
+        try:
+            bucket.delete(reference['file_id'])
+        except NoFile:
+            pass
+
+def migrate_photos(db):
+    """moves the photos stored as strings in doctor documents to GridFS.
+       Documents changed meanwhile are left for the next run.
+    """
+    query = {'$or': [{field: {'$type': 'string'}} for field in PHOTO_FIELDS]}
+    migrated = {'doctors': 0, 'photos': 0, 'skipped': 0}
+    for doctor in db['doctor'].find(query, {field: 1 for field in PHOTO_FIELDS}):
+        for field in PHOTO_FIELDS:
+            value = doctor.get(field)
+            if not isinstance(value, str):
+                continue
+            content_type, data = decode_photo(value)
+            reference = store_photo(db, io.BytesIO(data), field, content_type)
+            result = db['doctor'].update_one({'_id': doctor['_id'], field: value},
+                                             {'$set': {field: reference}})
+            if result.modified_count:
+                migrated['photos'] += 1
+            else:
+                delete_photos(db, [reference])
+                migrated['skipped'] += 1
+        migrated['doctors'] += 1
+
+    return migrated
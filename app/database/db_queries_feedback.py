@@ -1,6 +1,14 @@
 import datetime as dt
 import pymongo
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
 
+from app.database.db_policy import query_policy
+from app.database.pagination import find_page
+from app.helpers.metrics import instrumented_query
+
+@instrumented_query
+@query_policy('acknowledged_write')
 def post_feedback(db, feedback_info):
     """creates new_feedback"""
     feedback_info['_feedback_date'] = dt.datetime.utcnow()
@@ -12,8 +20,40 @@ def post_feedback(db, feedback_info):
         '_feedback_date': feedback_info['_feedback_date']
     }
 
-def get_feedback(db):
-    """get feedback"""
-    feedback_info = db['feedback'].find({},{'_id':0})
+def buffer_feedback(buffer, feedback_info):
+    """queues new_feedback in the write-behind buffer.
+       The id is assigned here so retried batches can't insert it twice.
+    """
+    feedback_info['_id'] = ObjectId()
+    feedback_info['_feedback_date'] = dt.datetime.utcnow()
+    buffer.put(feedback_info)
+
+    return {
+        'operation': 'enqueue',
+        'inserted': True,
+        '_feedback_date': feedback_info['_feedback_date']
+    }
+
+@instrumented_query
+@query_policy('acknowledged_write')
+def post_feedback_batch(db, feedbacks):
+    """inserts buffered feedback, skipping the already inserted ones"""
+    try:
+        db['feedback'].insert_many(feedbacks, ordered=False)
+    except BulkWriteError as error:
+        if any(write_error['code'] != 11000
+               for write_error in error.details.get('writeErrors', [])):
+            raise
+        if error.details.get('writeConcernErrors'):
+            raise
 
-    return list(feedback_info)
+@instrumented_query
+@query_policy('secondary_read')
+def get_feedback(db, limit=None, next_token=None, stream_batch_size=None):
+    """get feedback, newest first.
+       Returns the feedback (a cursor when streaming) and the token of the
+       next page.
+    """
+    return find_page(db['feedback'], {}, {'_id':0}, '_feedback_date',
+                     limit=limit, next_token=next_token,
+                     stream_batch_size=stream_batch_size)
@@ -1,41 +1,79 @@
 import datetime as dt
 import pymongo
+from pymongo.errors import DuplicateKeyError
 
+from app.database.db_policy import query_policy
+from app.database.projection import select_fields
+from app.helpers.metrics import instrumented_query
 
+REPORT_PROJECTION = {
+    'report_id': 1,
+    'statuses': 1,
+    '_last_update': 1,
+    '_report_creation_date': 1,
+    '_id': 0
+}
+
+
+def _report_changes(report_info, now):
+    """Returns the update that creates a report or replaces its statuses."""
+    return {
+        '$set' : {
+            'statuses' : report_info['statuses'],
+            '_last_update' : now
+        },
+        '$setOnInsert': {
+            '_report_creation_date': now
+        }
+    }
+
+
+@instrumented_query
+@query_policy('majority_write')
 def create_replace_report(db, report_info):
-    """ Creates an apointment with user info and consent in false if is not
-        present in appointment_info
+    """ Creates a report with its statuses or replaces the statuses if the
+        report already exists, in a single upsert.
     """
+    now = dt.datetime.utcnow()
+    changes = _report_changes(report_info, now)
 
-    if db['report'].find_one({'report_id': report_info['report_id']}):
-        result = db['report'].update(
-            {'report_id' : report_info['report_id']},
-            {
-                '$set' : {
-                    'statuses' : report_info['statuses'],
-                    '_last_update' : dt.datetime.utcnow()
-                }
-            }
-        )
+    try:
+        result = db['report'].update_one(
+            {'report_id' : report_info['report_id']}, changes, upsert=True)
+    except DuplicateKeyError:
+        # A concurrent PUT inserted the same report first.
+        result = db['report'].update_one(
+            {'report_id' : report_info['report_id']}, changes)
 
+    if result.upserted_id is not None:
         return {
-            'operation': 'update',
-            'n_matched': result['n'],
-            'modified': result['nModified']
+            'operation': 'insert',
+            'inserted': result.acknowledged,
+            '_report_creation_date': now
         }
 
-    report_info['_report_creation_date'] = dt.datetime.utcnow()
-    report_info['_last_update'] = report_info['_report_creation_date']
-    inserted = db['report'].insert_one(report_info)
     return {
-        'operation': 'insert',
-        'inserted': inserted.acknowledged,
-        '_report_creation_date': report_info['_report_creation_date']
+        'operation': 'update',
+        'n_matched': result.matched_count,
+        'modified': result.modified_count
     }
 
-def get_report_id(db, report_id):
+@instrumented_query
+@query_policy('primary_read')
+def get_report_id(db, report_id, fields=None):
     """Gets a report by and id from the database"""
 
-    report_info = db['report'].find_one({'report_id': report_id}, {'_id': 0})
+    report_info = db['report'].find_one({'report_id': report_id},
+                                        select_fields(REPORT_PROJECTION, fields))
 
     return report_info
+
+@instrumented_query
+@query_policy('primary_read')
+def get_report_last_update(db, report_id):
+    """Gets only the last update date of a report"""
+
+    report_info = db['report'].find_one({'report_id': report_id},
+                                        {'_last_update': 1, '_id': 0})
+
+    return report_info.get('_last_update') if report_info else None
@@ -1,7 +1,332 @@
-from pymongo import MongoClient
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
 
-def get_connection(user='', password='', mongo_uri='mongodb://localhost:27017/'):
-    client = MongoClient(mongo_uri)
-    return client
+from bson import SON
+from pymongo import MongoClient, monitoring
 
+logger = logging.getLogger(__name__)
 
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Keeps live counters of the connection pools of one client."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.waiting = 0
+        self.check_out_failures = 0
+
+    def _add(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add(created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(closed=1)
+
+    def connection_check_out_started(self, event):
+        self._add(waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._add(waiting=-1, check_out_failures=1)
+
+    def connection_checked_out(self, event):
+        self._add(waiting=-1, checked_out=1)
+
+    def connection_checked_in(self, event):
+        self._add(checked_out=-1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'open': self.created - self.closed,
+                'created': self.created,
+                'closed': self.closed,
+                'checked_out': self.checked_out,
+                'waiting': self.waiting,
+                'check_out_failures': self.check_out_failures
+            }
+
+
+def query_shape(value):
+    """Replaces the values of a filter, sort or pipeline by '?', keeping its
+       fields and operators, so queries that only differ in values match.
+    """
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(item, (dict, list, tuple)) for item in value):
+            return [query_shape(item) for item in value]
+        return ['?']
+    if isinstance(value, str) and value.startswith('$'):
+        # A field path of an aggregation expression, not a value.
+        return value
+    return '?'
+
+
+def command_shape(command_name, command):
+    """Returns the shape of the parts of a command that decide its plan."""
+    if command_name == 'find':
+        return {'filter': query_shape(command.get('filter', {})),
+                'sort': command.get('sort')}
+    if command_name == 'aggregate':
+        return {'pipeline': query_shape(command.get('pipeline', []))}
+    if command_name in ('count', 'distinct'):
+        return {'query': query_shape(command.get('query', {}))}
+    if command_name == 'findAndModify':
+        return {'query': query_shape(command.get('query', {})),
+                'sort': command.get('sort')}
+    if command_name == 'update':
+        return {'q': [query_shape(update.get('q', {}))
+                      for update in command.get('updates', [])[:1]]}
+    if command_name == 'delete':
+        return {'q': [query_shape(delete.get('q', {}))
+                      for delete in command.get('deletes', [])[:1]]}
+    return {}
+
+
+def calling_function():
+    """Returns module.function:line of the query function that issued the
+       running command, or of the first app frame if there is none.
+    """
+    caller = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith('app.') and module != __name__:
+            location = '%s.%s:%d' % (module, frame.f_code.co_name, frame.f_lineno)
+            if '.db_queries_' in module:
+                return location
+            caller = caller or location
+        frame = frame.f_back
+    return caller
+
+
+def _winning_plans(explain):
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'winningPlan':
+                yield value
+            else:
+                yield from _winning_plans(value)
+    elif isinstance(explain, list):
+        for item in explain:
+            yield from _winning_plans(item)
+
+
+def _plan_stages(plan):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_stages(item)
+
+
+def plan_summary(explain):
+    """Returns whether the winning plans scan a collection and the indexes
+       they use.
+    """
+    stages = [stage for plan in _winning_plans(explain)
+              for stage in _plan_stages(plan)]
+    return {
+        'collscan': any(stage['stage'] == 'COLLSCAN' for stage in stages),
+        'indexes': sorted({stage['indexName'] for stage in stages
+                           if 'indexName' in stage})
+    }
+
+
+class SlowQueryLogger(monitoring.CommandListener):
+    """Logs the commands slower than ``threshold_ms`` with their shape and
+       the query function that issued them.
+
+       With an ``explain_client``, a background thread also explains each
+       slow shape (at most once per ``explain_interval`` seconds) and logs
+       whether its plan was a COLLSCAN.
+    """
+
+    IGNORED = frozenset(['explain', 'isMaster', 'ismaster', 'hello', 'ping',
+                         'saslStart', 'saslContinue', 'getnonce',
+                         'authenticate', 'endSessions', 'killCursors'])
+    EXPLAINABLE = frozenset(['find', 'aggregate', 'count', 'distinct',
+                             'findAndModify', 'update', 'delete'])
+    # Session and transport fields explain doesn't accept.
+    NOT_EXPLAINED = frozenset(['lsid', 'txnNumber', 'autocommit',
+                               'startTransaction', 'writeConcern',
+                               'readConcern', '$db', '$clusterTime',
+                               '$readPreference'])
+
+    def __init__(self, threshold_ms, explain_client=None, explain_interval=3600):
+        self.threshold_micros = threshold_ms * 1000
+        self.explain_client = explain_client
+        self.explain_interval = explain_interval
+        self._commands = {}
+        self._explained = {}
+        self._explain_queue = queue.Queue(maxsize=100)
+        if explain_client is not None:
+            threading.Thread(target=self._explain_forever, daemon=True,
+                             name='explain-slow-queries').start()
+
+    def started(self, event):
+        if event.command_name not in self.IGNORED:
+            self._commands[(event.connection_id, event.request_id)] = (
+                event.command, event.database_name)
+
+    def succeeded(self, event):
+        self._finished(event, 'succeeded')
+
+    def failed(self, event):
+        self._finished(event, 'failed')
+
+    def _finished(self, event, outcome):
+        started = self._commands.pop((event.connection_id, event.request_id), None)
+        if started is None or event.duration_micros < self.threshold_micros:
+            return
+
+        # Sync clients report the end of a command in the thread that sent it.
+        command, database_name = started
+        command_name = event.command_name
+        collection = command.get(command_name)
+        shape = command_shape(command_name, command)
+        caller = calling_function()
+        logger.warning("Slow %s %s on %s.%s took %.1f ms from %s: %s",
+                       command_name, outcome, database_name, collection,
+                       event.duration_micros / 1000, caller or 'unknown',
+                       json.dumps(shape, default=str, sort_keys=True))
+
+        if self.explain_client is not None and command_name in self.EXPLAINABLE:
+            key = (database_name, collection, command_name,
+                   json.dumps(shape, default=str, sort_keys=True))
+            now = time.monotonic()
+            if now - self._explained.get(key, -self.explain_interval) >= self.explain_interval:
+                self._explained[key] = now
+                try:
+                    self._explain_queue.put_nowait((key, command, caller))
+                except queue.Full:
+                    pass
+
+    def _explain_forever(self):
+        while True:
+            key, command, caller = self._explain_queue.get()
+            database_name, collection, command_name, shape = key
+            explained = SON((name, value) for name, value in command.items()
+                            if name not in self.NOT_EXPLAINED)
+            try:
+                explain = self.explain_client[database_name].command(
+                    SON([('explain', explained), ('verbosity', 'queryPlanner')]))
+            except Exception:
+                logger.exception("Unable to explain slow %s on %s.%s",
+                                 command_name, database_name, collection)
+                continue
+            summary = plan_summary(explain)
+            log = logger.warning if summary['collscan'] else logger.info
+            log("Plan of slow %s on %s.%s from %s: %s, indexes %s: %s",
+                command_name, database_name, collection, caller or 'unknown',
+                'COLLSCAN' if summary['collscan'] else 'no collection scan',
+                summary['indexes'], shape)
+
+
+class ForkSafeClient:
+    """Creates the MongoClient on first use and again in every forked
+       process, so gunicorn workers never share the sockets of a client
+       created before the fork (e.g. with --preload).
+    """
+
+    def __init__(self, mongo_uri, slow_query_ms=None, explain_slow_queries=False,
+                 **options):
+        self.mongo_uri = mongo_uri
+        self.slow_query_ms = slow_query_ms
+        self.explain_slow_queries = explain_slow_queries
+        self.options = options
+        self._pool_stats = None
+        self.slow_queries = None
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Listeners hold threads and state of this process.
+                    self._pool_stats = PoolStats()
+                    listeners = [self._pool_stats]
+                    if self.slow_query_ms is not None:
+                        self.slow_queries = SlowQueryLogger(
+                            self.slow_query_ms,
+                            explain_client=self if self.explain_slow_queries else None)
+                        listeners.append(self.slow_queries)
+                    self._client = MongoClient(
+                        self.mongo_uri, event_listeners=listeners,
+                        **self.options)
+                    self._pid = os.getpid()
+        return self._client
+
+    def pool_stats(self):
+        """Returns the pool counters of the client of this process, empty
+           while it hasn't been created (the ones left are the parent's
+           after a fork).
+        """
+        if self._pid != os.getpid():
+            return {}
+        return self._pool_stats.stats()
+
+    def __getitem__(self, name):
+        return LazyDatabase(self, name)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class LazyDatabase:
+    """Database handle that resolves to the client of the current process."""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    @property
+    def database(self):
+        return self.client.client[self.name]
+
+    def __getitem__(self, name):
+        return self.database[name]
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+
+def get_connection(user='', password='', mongo_uri='mongodb://localhost:27017/',
+                   slow_query_ms=None, explain_slow_queries=False, **options):
+    """Returns a lazy, fork-aware client. Commands slower than
+       ``slow_query_ms`` are logged, and explained if ``explain_slow_queries``.
+       ``options`` are passed to MongoClient (maxPoolSize,
+       serverSelectionTimeoutMS, compressors...).
+    """
+    return ForkSafeClient(mongo_uri, slow_query_ms=slow_query_ms,
+                          explain_slow_queries=explain_slow_queries, **options)
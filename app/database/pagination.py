@@ -0,0 +1,108 @@
+import base64
+import datetime as dt
+import json
+import pymongo
+from bson import ObjectId
+from bson.errors import InvalidId
+
+
+# Page size of the callers that don't give one.
+DEFAULT_PAGE_SIZE = 100
+
+
+class InvalidPageToken(ValueError):
+    pass
+
+
+def encode_page_token(sort_key, sort_value, last_id):
+    """Builds the opaque token pointing after the document with
+       ``sort_value`` and ``last_id``.
+    """
+    if isinstance(sort_value, dt.datetime):
+        value = {'date': sort_value.isoformat()}
+    else:
+        value = {'value': sort_value}
+    data = json.dumps({'key': sort_key, 'id': str(last_id), **value},
+                      separators=(',', ':'))
+
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_page_token(sort_key, token):
+    """Returns the sort value and _id encoded in ``token``."""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if data['key'] != sort_key:
+            raise InvalidPageToken(token)
+        if 'date' in data:
+            value = dt.datetime.fromisoformat(data['date'])
+        else:
+            value = data['value']
+        return value, ObjectId(data['id'])
+    except (ValueError, KeyError, TypeError, InvalidId):
+        raise InvalidPageToken(token)
+
+
+def page_sort(sort_key):
+    return [(sort_key, pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+
+
+def find_page(collection, query, projection, sort_key, limit=None,
+              next_token=None, stream_batch_size=None):
+    """Finds documents sorted by ``sort_key`` (newest first) and _id, those
+       without it last.
+
+       At most ``limit`` (DEFAULT_PAGE_SIZE if not given) documents following
+       ``next_token`` are returned, using a range on the sort key instead of
+       skip so every page costs the same. Returns the documents and the token
+       of the next page (None on the last page). When ``stream_batch_size``
+       is given and there's no limit, the cursor over every matching
+       document is returned instead so the caller can iterate it in batches.
+    """
+    sort = page_sort(sort_key)
+
+    if limit is None and stream_batch_size:
+        cursor = collection.find(query, projection).sort(sort)
+        return cursor.batch_size(stream_batch_size), None
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+
+    if next_token:
+        value, last_id = decode_page_token(sort_key, next_token)
+        following = [{sort_key: value, '_id': {'$lt': last_id}}]
+        if value is not None:
+            # Documents without the sort key come last, after every value.
+            following += [{sort_key: {'$lt': value}}, {sort_key: None}]
+        query = {'$and': [query, {'$or': following}]}
+
+    # The sort key and _id are read to build the next token, and dropped
+    # afterwards if the client didn't ask for them.
+    inclusive = any(projection.get(field) for field in projection
+                    if field != '_id')
+    hidden = set()
+    projection = dict(projection)
+    if inclusive:
+        for field in (sort_key, '_id'):
+            if not projection.get(field):
+                projection[field] = 1
+                hidden.add(field)
+    elif '_id' in projection:
+        del projection['_id']
+        hidden.add('_id')
+
+    # An empty projection would make pymongo return only the _id.
+    documents = list(collection.find(query, projection or None)
+                     .sort(sort).limit(limit + 1))
+
+    token = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        last = documents[-1]
+        token = encode_page_token(sort_key, last.get(sort_key), last['_id'])
+
+    for document in documents:
+        for field in hidden:
+            document.pop(field, None)
+
+    return documents, token
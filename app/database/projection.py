@@ -0,0 +1,38 @@
+class InvalidFields(ValueError):
+    """Raised when a client asks for fields a resource doesn't return."""
+
+    def __init__(self, unknown, allowed):
+        super().__init__(unknown)
+        self.unknown = unknown
+        self.allowed = allowed
+
+
+def parse_fields(value):
+    """Splits the ``fields`` query parameter. Returns None when it is absent."""
+    if value is None:
+        return None
+    fields = []
+    for field in value.split(','):
+        field = field.strip()
+        if field and field not in fields:
+            fields.append(field)
+    return fields
+
+
+def select_fields(projection, fields):
+    """Narrows an inclusive projection to the ``fields`` asked by the client,
+       which must be among the ones it includes. Returns ``projection`` when
+       no fields are asked.
+    """
+    if fields is None:
+        return projection
+
+    allowed = [field for field, included in projection.items()
+               if included and field != '_id']
+    unknown = [field for field in fields if field not in allowed]
+    if unknown or not fields:
+        raise InvalidFields(unknown, allowed)
+
+    selected = {field: 1 for field in fields}
+    selected['_id'] = 0
+    return selected
@@ -0,0 +1,141 @@
+"""In-process read-through cache of reports and of their latest diagnostic.
+
+Entries are dropped as soon as a change stream on the ``report`` and
+``diagnostic`` collections shows a write to their report, in every worker,
+and after ``ttl`` seconds at most. When change streams are unavailable (a
+standalone mongod) or the stream fails, entries only live ``fallback_ttl``
+seconds.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from app.helpers import metrics
+
+logger = logging.getLogger(__name__)
+
+CHANGE_PIPELINE = [
+    {'$match': {'ns.coll': {'$in': ['report', 'diagnostic']}}},
+    {'$project': {'operationType': 1, 'ns': 1, 'fullDocument.report_id': 1,
+                  'updateDescription.updatedFields.report_id': 1}}
+]
+
+
+class ReportCache:
+    """LRU cache of at most ``max_size`` query results, keyed by
+       ``(kind, report_id, ...)`` so a write to a report drops all of its
+       entries. A ``max_size`` of 0 disables it.
+    """
+
+    def __init__(self, max_size=10000, ttl=60, fallback_ttl=1):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.fallback_ttl = fallback_ttl
+        self.watching = False
+        self._entries = OrderedDict()
+        # report_id -> keys of its entries.
+        self._keys = {}
+        # Bumped by every invalidation, so a result read before one isn't
+        # stored after it.
+        self._generation = 0
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return True, entry[1], None
+            return False, None, self._generation
+
+    def _store(self, key, value, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            ttl = self.ttl if self.watching else self.fallback_ttl
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            self._keys.setdefault(key[1], set()).add(key)
+            while len(self._entries) > self.max_size:
+                evicted, _ = self._entries.popitem(last=False)
+                self._forget(evicted)
+
+    def _forget(self, key):
+        keys = self._keys.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[key[1]]
+
+    def load(self, key, loader):
+        """Returns the cached result for ``key`` or stores the one of
+           ``loader()``.
+        """
+        if not self.max_size:
+            return loader()
+        found, value, generation = self._lookup(key)
+        metrics.CACHE_REQUESTS.inc(key[0], 'hit' if found else 'miss')
+        if found:
+            return value
+        value = loader()
+        self._store(key, value, generation)
+        return value
+
+    def invalidate(self, report_id):
+        with self._lock:
+            self._generation += 1
+            for key in self._keys.pop(report_id, ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._keys.clear()
+
+    def apply_change(self, change):
+        """Drops the entries of the report a change stream event touched, or
+           every entry when it can't be told (deletes, drops, a moved
+           diagnostic).
+        """
+        report_id = (change.get('fullDocument') or {}).get('report_id')
+        updated = (change.get('updateDescription') or {}).get('updatedFields') or {}
+        if (change['operationType'] in ('insert', 'update', 'replace')
+                and report_id is not None and 'report_id' not in updated):
+            self.invalidate(report_id)
+        else:
+            self.clear()
+
+    def _watch_started(self):
+        # Entries stored before the stream started may have missed a write.
+        self.clear()
+        self.watching = True
+        if self._failures:
+            logger.info("Report cache change stream resumed")
+        self._failures = 0
+
+    def _watch_stopped(self, error=None):
+        self.watching = False
+        self.clear()
+        if error is not None:
+            log = logger.warning if not self._failures else logger.debug
+            log("Report cache change stream unavailable, entries live %ss: %s",
+                self.fallback_ttl, error)
+            self._failures += 1
+
+    def watch(self, db):
+        """Applies the changes of ``db`` until the stream ends or fails."""
+        if not self.max_size:
+            return
+        try:
+            with db.watch(CHANGE_PIPELINE, full_document='updateLookup') as stream:
+                self._watch_started()
+                for change in stream:
+                    self.apply_change(change)
+        except Exception as error:
+            # Whatever failed, entries live fallback_ttl until the next try.
+            self._watch_stopped(error)
+        else:
+            self._watch_stopped()
@@ -0,0 +1,255 @@
+"""Write-behind buffering of inserts.
+
+A document is acknowledged once it is appended and fsync'd to a local
+journal; a background thread writes the buffered documents with one
+``insert_many`` per batch. The journal is split in segments, one per batch,
+removed once the batch is written, so documents survive a crash or a Mongo
+outage and are written by the next worker that starts.
+
+Each buffer holds a lock on a file of its own for as long as its process
+lives, so the segments of a buffer whose lock file isn't locked anymore are
+the ones left by a crash.
+"""
+import atexit
+import fcntl
+import glob
+import logging
+import os
+import re
+import threading
+import uuid
+
+from bson import json_util
+
+logger = logging.getLogger(__name__)
+
+
+class BufferFull(Exception):
+    """Raised when the buffer stayed full for the whole put timeout."""
+
+
+def _try_lock(path):
+    """Locks the file at ``path``, creating it if needed. Returns its
+       descriptor, or None if another process holds the lock.
+    """
+    descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(descriptor)
+        return None
+    return descriptor
+
+
+class WriteBehindBuffer:
+    """Buffers documents for ``flush``, a function inserting a list of them.
+
+       Batches are written when ``flush_size`` documents are waiting or every
+       ``flush_interval`` seconds. At most ``max_size`` documents are held in
+       memory; ``put`` waits up to ``put_timeout`` seconds for room and then
+       raises BufferFull. Failed batches are retried every ``retry_interval``
+       seconds, so ``flush`` must ignore documents already inserted (they
+       carry their ``_id``).
+
+       Like the Mongo client, the buffer starts in each process on first use
+       and flushes what is left when the process exits.
+    """
+
+    def __init__(self, name, flush, directory, max_size=10000, flush_size=500,
+                 flush_interval=1.0, put_timeout=1.0, retry_interval=5.0):
+        self.name = name
+        self.flush = flush
+        self.directory = directory
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retry_interval = retry_interval
+        self._pid = None
+        self._owner_lock = None
+        self._lock = threading.Lock()
+
+    def _lock_path(self, owner):
+        return os.path.join(self.directory, '%s-%s.lock' % (self.name, owner))
+
+    def _segment_path(self, sequence):
+        return os.path.join(self.directory, '%s-%s-%d.jsonl' % (
+            self.name, self._owner, sequence))
+
+    def _open_segment(self):
+        self._sequence += 1
+        self._journal_path = self._segment_path(self._sequence)
+        self._journal = open(self._journal_path, 'a')
+
+    def _recover(self):
+        """Claims the segments of the buffers whose lock file is unlocked,
+           or missing, because their process is gone.
+        """
+        pattern = re.compile(r'%s-(\w+)-\d+\.jsonl$' % re.escape(self.name))
+        orphans = {}
+        for path in sorted(glob.glob(os.path.join(self.directory, self.name + '-*.jsonl'))):
+            match = pattern.search(path)
+            if match and match.group(1) != self._owner:
+                orphans.setdefault(match.group(1), []).append(path)
+
+        for owner, paths in orphans.items():
+            lock_path = self._lock_path(owner)
+            descriptor = _try_lock(lock_path)
+            if descriptor is None:
+                continue
+            try:
+                for path in paths:
+                    self._claim(path)
+                os.remove(lock_path)
+            finally:
+                os.close(descriptor)
+
+    def _claim(self, path):
+        """Moves a segment to this buffer and queues its documents."""
+        self._sequence += 1
+        claimed = self._segment_path(self._sequence)
+        try:
+            # Another worker may claim the same segment first.
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return
+        documents = []
+        with open(claimed) as journal:
+            for line in journal:
+                try:
+                    documents.append(json_util.loads(line))
+                except ValueError:
+                    # Torn write of a put that was never acknowledged.
+                    logger.warning("Skipping a truncated line of %s", claimed)
+        self._segments.append((claimed, documents))
+        self._size += len(documents)
+        logger.info("Recovered %d documents from %s", len(documents), path)
+
+    def _start(self):
+        if self._owner_lock is not None:
+            # Inherited from the parent, which still holds the lock.
+            os.close(self._owner_lock)
+        self._pid = os.getpid()
+        self._owner = uuid.uuid4().hex
+        self._condition = threading.Condition()
+        # Serializes the fsyncs; each covers every line written before it.
+        self._sync_lock = threading.Lock()
+        self._written = 0
+        self._synced = 0
+        self._pending = []
+        # Closed segments waiting to be written: [(path, documents)].
+        self._segments = []
+        self._size = 0
+        self._sequence = 0
+        self._closed = False
+        os.makedirs(self.directory, exist_ok=True)
+        self._owner_lock = _try_lock(self._lock_path(self._owner))
+        self._recover()
+        self._open_segment()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='write-behind-%s' % self.name)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._start()
+
+    def put(self, document):
+        """Returns once ``document`` is in the journal."""
+        self._ensure_started()
+        line = json_util.dumps(document) + '\n'
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: self._size < self.max_size or self._closed,
+                    self.put_timeout) or self._closed:
+                raise BufferFull(self.name)
+            self._journal.write(line)
+            self._journal.flush()
+            self._written += 1
+            written = self._written
+            self._pending.append(document)
+            self._size += 1
+            if len(self._pending) >= self.flush_size:
+                self._condition.notify_all()
+        self._sync(written)
+
+    def _sync(self, written):
+        """Waits until the first ``written`` lines are on disk. The puts that
+           wrote while an fsync ran share the next one.
+        """
+        with self._sync_lock:
+            if self._synced >= written:
+                return
+            with self._condition:
+                target = self._written
+                # A duplicate stays valid if the segment is rotated meanwhile.
+                descriptor = os.dup(self._journal.fileno())
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+            self._synced = target
+
+    def _rotate(self, reopen=True):
+        # Lines written to the closed segment are synced before its puts.
+        os.fsync(self._journal.fileno())
+        self._journal.close()
+        if self._pending:
+            self._segments.append((self._journal_path, self._pending))
+            self._pending = []
+        else:
+            os.remove(self._journal_path)
+        if reopen:
+            self._open_segment()
+
+    def _write_segments(self):
+        """Writes the closed segments in order. Returns False on failure."""
+        with self._condition:
+            segments = list(self._segments)
+        for path, documents in segments:
+            try:
+                self.flush(documents)
+            except Exception:
+                logger.exception("Write-behind %s failed to write %d documents, "
+                                 "retrying in %ss", self.name, len(documents),
+                                 self.retry_interval)
+                return False
+            os.remove(path)
+            with self._condition:
+                self._segments.remove((path, documents))
+                self._size -= len(documents)
+                self._condition.notify_all()
+        return True
+
+    def _run(self):
+        delay = self.flush_interval
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._closed or len(self._pending) >= self.flush_size,
+                    delay)
+                closed = self._closed
+                if self._pending or closed:
+                    self._rotate(reopen=not closed)
+            written = self._write_segments()
+            if closed:
+                if not written:
+                    logger.error("Write-behind %s left %d documents in %s",
+                                 self.name, self._size, self.directory)
+                else:
+                    os.remove(self._lock_path(self._owner))
+                return
+            delay = self.flush_interval if written else self.retry_interval
+
+    def close(self, timeout=30):
+        """Writes the buffered documents and stops the buffer."""
+        if self._pid != os.getpid() or self._closed:
+            return
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
@@ -1,8 +1,19 @@
+from collections import OrderedDict
 from functools import wraps
+import hashlib
 import json
+import logging
+import threading
+import time
 from jose import jwt
 from six.moves.urllib.request import urlopen
 
+from app.helpers import metrics
+from app.helpers.metrics import timed_phase
+
+
+logger = logging.getLogger(__name__)
+
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -10,11 +21,217 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+class JWKSUnavailable(Exception):
+    """No key set has been fetched yet and the last attempt failed too
+       recently to try again.
+    """
+
+
+class JWKSStore:
+    """Process-wide cache of the signing keys published in a JWKS document.
+
+       Keys are refreshed when they are older than ``ttl`` seconds or when a
+       token references an unknown ``kid``. Refreshes are single-flight: one
+       thread fetches while the others keep using the cached keys (or wait if
+       there are none yet). Fetches are never attempted more often than
+       every ``min_refresh_interval`` seconds, so tokens with bogus key ids
+       can't force a fetch per request, and while the issuer is unreachable
+       before any key was fetched JWKSUnavailable is raised right away.
+    """
+
+    def __init__(self, jwks_url, ttl=600, min_refresh_interval=30, timeout=5):
+        self.jwks_url = jwks_url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.version = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+
+    def _fetch(self):
+        jsonurl = urlopen(self.jwks_url, timeout=self.timeout)
+        jwks = json.loads(jsonurl.read())
+
+        return {
+            key["kid"]: {
+                "kty": key["kty"],
+                "kid": key["kid"],
+                "use": key["use"],
+                "n": key["n"],
+                "e": key["e"]
+            }
+            for key in jwks["keys"] if "kid" in key
+        }
+
+    def _may_refresh(self, now):
+        return (self._last_attempt is None or
+                now - self._last_attempt >= self.min_refresh_interval)
+
+    def refresh(self):
+        """Fetches the key set unless another thread is already doing it.
+           Returns once fresh keys are available or when the stale ones can
+           keep being served.
+        """
+        generation = self.version
+        blocking = not self._keys
+        if not self._lock.acquire(blocking=blocking):
+            return
+        try:
+            if self.version != generation and self._keys:
+                return
+            if not self._keys and not self._may_refresh(time.monotonic()):
+                # The fetch this thread waited for failed.
+                raise JWKSUnavailable("No keys fetched from %s yet" % self.jwks_url)
+            self._last_attempt = time.monotonic()
+            try:
+                keys = self._fetch()
+            except Exception:
+                if not self._keys:
+                    raise
+                logger.exception("JWKS refresh failed, serving cached keys")
+                return
+            if keys != self._keys:
+                self._keys = keys
+                self.version += 1
+            self._fetched_at = self._last_attempt
+        finally:
+            self._lock.release()
+
+    def refresh_if_due(self):
+        """Refreshes the key set when there is none yet or it is older than
+           ``ttl``. Raises if the key set could never be fetched.
+        """
+        now = time.monotonic()
+        if not self._keys:
+            # Waits for a first fetch in flight, fails fast after one failed.
+            if not self._may_refresh(now) and not self._lock.locked():
+                raise JWKSUnavailable("No keys fetched from %s yet" % self.jwks_url)
+            self.refresh()
+        elif now - self._fetched_at > self.ttl and self._may_refresh(now):
+            self.refresh()
+
+    def _lookup(self, kid):
+        # refresh() replaces the keys before bumping the version, so the
+        # version read first is never newer than the key.
+        version = self.version
+        return self._keys.get(kid), version
+
+    def get_key(self, kid):
+        """Returns the key for ``kid``, or None if the issuer doesn't publish
+           it, and the version of the key set it was found in. Raises if the
+           key set could never be fetched.
+        """
+        self.refresh_if_due()
+
+        key, version = self._lookup(kid)
+        if key is None and self._may_refresh(time.monotonic()):
+            self.refresh()
+            key, version = self._lookup(kid)
+        return key, version
+
+    def check(self):
+        """Refreshes the key set if it's due, as ``get_key`` would, and returns
+           the number of keys and their age in seconds. Raises if the key set
+           could never be fetched.
+        """
+        self.refresh_if_due()
+        return {'keys': len(self._keys),
+                'age_s': round(time.monotonic() - self._fetched_at, 1)}
+
+
+class TokenCache:
+    """Bounded LRU of verified token payloads keyed by a digest of the token.
+
+       Entries expire at the token's ``exp`` claim and the whole cache is
+       dropped whenever the key set it was verified against changes.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._jwks_version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def _check_version(self, jwks_version):
+        if jwks_version != self._jwks_version:
+            self._entries.clear()
+            self._jwks_version = jwks_version
+
+    def get(self, token, jwks_version):
+        digest = self._digest(token)
+        with self._lock:
+            self._check_version(jwks_version)
+            entry = self._entries.get(digest)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(digest)
+                self.hits += 1
+            else:
+                if entry is not None:
+                    del self._entries[digest]
+                self.misses += 1
+                entry = None
+            size = len(self._entries)
+        metrics.TOKEN_CACHE_REQUESTS.inc('miss' if entry is None else 'hit')
+        metrics.TOKEN_CACHE_SIZE.set(size)
+        return None if entry is None else entry[1]
+
+    def put(self, token, payload, jwks_version):
+        expires_at = payload.get("exp")
+        if self.max_size <= 0 or not isinstance(expires_at, (int, float)):
+            return
+        digest = self._digest(token)
+        with self._lock:
+            if self._jwks_version is not None and jwks_version < self._jwks_version:
+                # Verified against a key set replaced since.
+                return
+            self._check_version(jwks_version)
+            self._entries[digest] = (expires_at, payload)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            size = len(self._entries)
+        metrics.TOKEN_CACHE_SIZE.set(size)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._entries)}
+
+
+_jwks_stores = {}
+_jwks_stores_lock = threading.Lock()
+
+
+def get_jwks_store(jwks_url, **kwargs):
+    """Returns the process-wide store for ``jwks_url``, creating it once."""
+    with _jwks_stores_lock:
+        if jwks_url not in _jwks_stores:
+            _jwks_stores[jwks_url] = JWKSStore(jwks_url, **kwargs)
+        return _jwks_stores[jwks_url]
+
+
 class AuthHandler:
-    def __init__(self, auth0_domain, algorithms, api_identifier):
+    def __init__(self, auth0_domain, algorithms, api_identifier,
+                 jwks_ttl=600, jwks_min_refresh_interval=30,
+                 token_cache_size=10000, jwks_url=None):
         self.auth0_domain = auth0_domain
         self.algorithms = algorithms
         self.api_identifier = api_identifier
+        # jwks_url only overrides the tenant's key set, e.g. with the local
+        # one of the load harness; tokens are still checked against the
+        # tenant issuer.
+        self.jwks = get_jwks_store(
+            jwks_url or "https://"+self.auth0_domain+"/.well-known/jwks.json",
+            ttl=jwks_ttl, min_refresh_interval=jwks_min_refresh_interval)
+        self.token_cache = TokenCache(max_size=token_cache_size)
 
     def _get_token_auth_header(self, request):
         """Obtains the access token from the Authorization Header
@@ -44,6 +261,13 @@ class AuthHandler:
         token = parts[1]
         return token
 
+    @staticmethod
+    def _jwks_unavailable():
+        return AuthError({
+            "code": "jwks_unavailable",
+            "message": "Unable to fetch signing keys, try again later"}, 503)
+
+    @timed_phase('auth')
     def get_payload(self, request):
 
         token = self._get_token_auth_header(request)
@@ -51,8 +275,20 @@ class AuthHandler:
         if isinstance(token, AuthError):
             return token
 
-        jsonurl = urlopen("https://"+self.auth0_domain+"/.well-known/jwks.json")
-        jwks = json.loads(jsonurl.read())
+        # A cached payload is only as good as the key set it was verified
+        # against, so the key set is kept as fresh as for a full check and a
+        # rotation drops the cache.
+        try:
+            self.jwks.refresh_if_due()
+        except JWKSUnavailable:
+            return self._jwks_unavailable()
+        except Exception:
+            logger.exception("Unable to fetch JWKS")
+            return self._jwks_unavailable()
+        payload = self.token_cache.get(token, self.jwks.version)
+        if payload is not None:
+            return payload
+
         try:
             unverified_header = jwt.get_unverified_header(token)
         except jwt.JWTError:
@@ -64,16 +300,13 @@ class AuthHandler:
                 "code": "invalid_header",
                 "message": "Invalid header. Use an RS256 signed JWT Access Token"}, 401)
 
-        rsa_key = {}
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = {
-                    "kty": key["kty"],
-                    "kid": key["kid"],
-                    "use": key["use"],
-                    "n": key["n"],
-                    "e": key["e"]
-                }
+        try:
+            rsa_key, jwks_version = self.jwks.get_key(unverified_header.get("kid"))
+        except JWKSUnavailable:
+            return self._jwks_unavailable()
+        except Exception:
+            logger.exception("Unable to fetch JWKS")
+            return self._jwks_unavailable()
         if rsa_key:
             try:
                 payload = jwt.decode(
@@ -96,6 +329,7 @@ class AuthHandler:
                     "code": "invalid_header",
                     "message": "Unable to parse authentication  token."}, 401)
 
+            self.token_cache.put(token, payload, jwks_version)
             return payload
         return AuthError({
             "code": "invalid_header",
@@ -0,0 +1,24 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def run_periodically(function, interval, name, immediately=False):
+    """Calls ``function`` every ``interval`` seconds in a daemon thread, the
+       first time right away if ``immediately``. Errors are logged and don't
+       stop the loop. Returns an event that stops the thread when set.
+    """
+    stopped = threading.Event()
+
+    def loop():
+        delay = 0 if immediately else interval
+        while not stopped.wait(delay):
+            delay = interval
+            try:
+                function()
+            except Exception:
+                logger.exception("Periodic job %s failed", name)
+
+    threading.Thread(target=loop, name=name, daemon=True).start()
+    return stopped
@@ -0,0 +1,145 @@
+"""Content-Encoding negotiation for JSON responses.
+
+gzip is always available; br and zstd are offered when the ``brotli`` and
+``zstandard`` packages are installed. Streamed responses are compressed
+chunk by chunk, flushing after each one so clients can decode what was sent.
+"""
+import logging
+import zlib
+from collections import namedtuple
+
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+# Compressor of one streamed body: ``flush`` returns everything compressed so
+# far and ``finish`` ends the stream.
+StreamCompressor = namedtuple('StreamCompressor', 'compress flush finish')
+
+
+class GzipEncoder:
+    name = 'gzip'
+    available = True
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def stream(self):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return StreamCompressor(compressor.compress,
+                                lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+                                compressor.flush)
+
+
+class BrotliEncoder:
+    name = 'br'
+    available = brotli is not None
+
+    def __init__(self, level=4):
+        self.level = level
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.level)
+
+    def stream(self):
+        compressor = brotli.Compressor(quality=self.level)
+        return StreamCompressor(compressor.process, compressor.flush,
+                                compressor.finish)
+
+
+class ZstdEncoder:
+    name = 'zstd'
+    available = zstandard is not None
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def stream(self):
+        compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+        return StreamCompressor(
+            compressor.compress,
+            lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+            compressor.flush)
+
+
+ENCODERS = {encoder.name: encoder
+            for encoder in (GzipEncoder, BrotliEncoder, ZstdEncoder)}
+
+
+def compressed_chunks(encoder, chunks):
+    """Compresses an iterable of byte chunks, flushing after each one."""
+    stream = encoder.stream()
+    try:
+        for chunk in chunks:
+            data = stream.compress(chunk) + stream.flush()
+            if data:
+                yield data
+        yield stream.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def weak_etag(etag):
+    """The compressed bytes differ from the identity ones, so a strong ETag
+       must become weak.
+    """
+    return etag if not etag or etag.startswith('W/') else 'W/' + etag
+
+
+class Compression:
+    """Chooses the encoding of a response from the client's Accept-Encoding.
+
+       ``encoders`` are in order of preference, used to break ties between
+       encodings the client accepts equally. Bodies shorter than ``min_size``
+       are sent as they are; streamed bodies are always compressed.
+    """
+
+    def __init__(self, encoders, min_size=1024):
+        self.encoders = {encoder.name: encoder for encoder in encoders}
+        self.min_size = min_size
+
+    @classmethod
+    def from_names(cls, names, levels, min_size=1024):
+        encoders = []
+        for name in names:
+            encoder = ENCODERS.get(name)
+            if encoder is None:
+                raise ValueError('Unknown content encoding %r' % name)
+            if not encoder.available:
+                logger.info("%s compression is not installed, skipped", name)
+                continue
+            encoders.append(encoder(levels[name]))
+        return cls(encoders, min_size)
+
+    @staticmethod
+    def compressible(status, content_type, content_encoding):
+        return (200 <= status and status not in (204, 206, 304)
+                and not content_encoding
+                and (content_type or '').startswith(COMPRESSIBLE_TYPES))
+
+    def negotiate(self, accept_encoding):
+        """Returns the encoder to use, or None to send identity."""
+        if not accept_encoding or not self.encoders:
+            return None
+        name = parse_accept_header(accept_encoding).best_match(list(self.encoders))
+        return self.encoders.get(name)
@@ -0,0 +1,67 @@
+import hashlib
+
+from flask import make_response
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag
+
+# Representations that never change under their URL, e.g. stored photos.
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+
+def make_etag(last_update, *parts):
+    """Builds an entity tag from the last update date of a resource and
+       anything else that identifies the representation.
+    """
+    version = repr((last_update.isoformat(), parts)).encode()
+    return hashlib.sha1(version).hexdigest()
+
+
+def is_not_modified(headers, etag, last_modified):
+    """Checks If-None-Match and, when it is absent, If-Modified-Since."""
+    if headers.get('If-None-Match'):
+        return parse_etags(headers['If-None-Match']).contains_weak(etag)
+    since = parse_date(headers.get('If-Modified-Since'))
+    if since and last_modified:
+        # Dates are naive UTC in the database; HTTP dates have no fractions.
+        since = since.replace(tzinfo=None)
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+def pop_last_update(documents):
+    """Returns the latest ``_last_update`` of ``documents``, read only to
+       build their validators, and copies of them without it.
+    """
+    dates = [document['_last_update'] for document in documents
+             if document.get('_last_update')]
+    documents = [{field: value for field, value in document.items()
+                  if field != '_last_update'} for document in documents]
+    return max(dates) if dates else None, documents
+
+
+def validator_headers(etag, last_modified):
+    """Returns ETag and Last-Modified so clients can poll conditionally."""
+    return {
+        'ETag': quote_etag(etag),
+        'Last-Modified': http_date(last_modified.utctimetuple()),
+        'Cache-Control': 'no-cache'
+    }
+
+
+def set_validators(response, etag, last_modified):
+    response.headers.update(validator_headers(etag, last_modified))
+    return response
+
+
+def not_modified_response(etag, last_modified):
+    return set_validators(make_response('', 304), etag, last_modified)
+
+
+def immutable_headers(etag, last_modified):
+    """Validators of a representation that never changes, which clients may
+       cache for a year and fetch by byte ranges.
+    """
+    headers = validator_headers(etag, last_modified)
+    headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    headers['Accept-Ranges'] = 'bytes'
+    return headers
+
@@ -0,0 +1,60 @@
+import datetime as dt
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class HealthProber:
+    """Runs the health checks in the background and keeps their last result,
+       so probes are answered from memory and never wait on a dependency.
+
+       ``checks`` maps a name to a callable that raises when the dependency
+       is unhealthy and may return details. Results older than
+       ``stale_after`` seconds count as failures, which covers a check stuck
+       on a timeout.
+    """
+
+    def __init__(self, checks, interval=5, stale_after=None):
+        self.checks = checks
+        self.interval = interval
+        self.stale_after = stale_after or 3 * interval
+        self._results = {}
+
+    def _record(self, name, start, details=None, error=None):
+        self._results[name] = {
+            'ok': error is None,
+            'checked_at': dt.datetime.utcnow(),
+            'latency_ms': round((time.monotonic() - start) * 1000, 1),
+            'details': details,
+            'error': None if error is None else '%s: %s' % (type(error).__name__, error),
+            '_monotonic': time.monotonic()
+        }
+        if error is not None:
+            logger.warning("Health check %s failed: %s", name, error)
+
+    def probe(self):
+        for name, check in self.checks.items():
+            start = time.monotonic()
+            try:
+                self._record(name, start, details=check())
+            except Exception as error:
+                self._record(name, start, error=error)
+
+    def results(self):
+        """Returns whether every check passed recently, and the last result
+           of each check.
+        """
+        now = time.monotonic()
+        results, ready = {}, True
+        for name in self.checks:
+            result = dict(self._results.get(name) or {
+                'ok': False, 'checked_at': None, 'latency_ms': None,
+                'details': None, 'error': 'not checked yet', '_monotonic': None})
+            checked = result.pop('_monotonic')
+            if checked is not None and now - checked > self.stale_after:
+                result['ok'] = False
+                result['error'] = 'stale, last checked %.0fs ago' % (now - checked)
+            ready = ready and result['ok']
+            results[name] = result
+        return ready, results
@@ -0,0 +1,244 @@
+"""In-process request and query metrics, rendered in the Prometheus text
+format by the /metrics endpoint.
+
+Request time is split into the auth, validation, database and
+serialisation phases. Code timed with ``phase`` (or with the
+``instrumented_query`` decorator) adds to the phases of the request being
+served, found through a context variable, so each thread sees its own
+request. Each process keeps its own metrics: scrape every
+worker, or run one worker per scrape target.
+"""
+import bisect
+import contextvars
+import functools
+import threading
+from time import perf_counter
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PHASES = ('auth', 'validation', 'database', 'serialisation')
+
+_request_phases = contextvars.ContextVar('request_phases', default=None)
+# Key of the phases dict holding the time of the phases nested in the open one.
+_NESTED = None
+
+
+def _labels(names, values):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                 .replace('"', '\\"'))
+                    for name, value in zip(names, values))
+
+
+class Counter:
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + 1
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s counter' % self.name]
+        lines += ['%s{%s} %d' % (self.name, _labels(self.labelnames, labels), value)
+                  for labels, value in values]
+        return lines
+
+
+class Gauge:
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s gauge' % self.name]
+        lines += ['%s{%s} %r' % (self.name, _labels(self.labelnames, labels), value)
+                  for labels, value in values]
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, labelnames, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [count per bucket, with +Inf last; sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        with self._lock:
+            series = sorted((labels, list(counts), total)
+                            for labels, (counts, total) in self._series.items())
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s histogram' % self.name]
+        for labels, counts, total in series:
+            labels = _labels(self.labelnames, labels)
+            separator = ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket{%s%sle="%s"} %d' % (
+                    self.name, labels, separator, bound, cumulative))
+            lines.append('%s_sum{%s} %r' % (self.name, labels, total))
+            lines.append('%s_count{%s} %d' % (self.name, labels, cumulative))
+        return lines
+
+
+REQUESTS = Counter('http_requests_total', 'Requests served, by status code.',
+                   ('method', 'route', 'status'))
+REQUEST_SECONDS = Histogram('http_request_duration_seconds',
+                            'Time to build the response of a request.',
+                            ('method', 'route'))
+PHASE_SECONDS = Histogram('http_request_phase_seconds',
+                          'Time spent by a request in each phase.',
+                          ('method', 'route', 'phase'))
+QUERY_SECONDS = Histogram('db_query_duration_seconds',
+                          'Time spent in each db_queries function.',
+                          ('function',))
+CACHE_REQUESTS = Counter('report_cache_requests_total',
+                         'Report cache lookups, by kind and result.',
+                         ('kind', 'result'))
+VIDEOCALL_CODE_ATTEMPTS = Counter(
+    'videocall_code_attempts_total',
+    'Videocall codes drawn, by whether the code was free or taken.',
+    ('result',))
+VIDEOCALL_CODE_OCCUPANCY = Gauge(
+    'videocall_code_estimated_occupancy',
+    'Fraction of the videocall code space in use, estimated from the '
+    'collision rate of the last attempts.', ())
+TOKEN_CACHE_REQUESTS = Counter('token_cache_requests_total',
+                               'Verified token cache lookups, by result.',
+                               ('result',))
+TOKEN_CACHE_SIZE = Gauge('token_cache_entries',
+                         'Verified tokens held in the token cache.', ())
+
+METRICS = (REQUESTS, REQUEST_SECONDS, PHASE_SECONDS, QUERY_SECONDS,
+           CACHE_REQUESTS, VIDEOCALL_CODE_ATTEMPTS, VIDEOCALL_CODE_OCCUPANCY,
+           TOKEN_CACHE_REQUESTS, TOKEN_CACHE_SIZE)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class phase:
+    """Adds the time spent in the block to ``name`` for the current request.
+       Phases are exclusive: time in a nested phase (e.g. decoding the body
+       while parsing arguments) only counts for the inner one.
+    """
+
+    __slots__ = ('name', 'phases', 'start', 'outer_nested')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.phases = _request_phases.get()
+        if self.phases is not None:
+            self.outer_nested = self.phases.get(_NESTED, 0.0)
+            self.phases[_NESTED] = 0.0
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        phases = self.phases
+        if phases is not None:
+            elapsed = perf_counter() - self.start
+            phases[self.name] = (phases.get(self.name, 0.0) + elapsed
+                                 - phases[_NESTED])
+            phases[_NESTED] = self.outer_nested + elapsed
+
+
+class track_request:
+    """Records the latency, phases and status of the request served in the
+       block. Set ``status`` before leaving it; an exception counts as its
+       ``code`` attribute (HTTPException) or 500.
+    """
+
+    __slots__ = ('method', 'route', 'status', 'start', 'phases', 'token')
+
+    def __init__(self, method, route):
+        self.method = method
+        self.route = route
+        self.status = None
+
+    def __enter__(self):
+        self.phases = {}
+        self.token = _request_phases.set(self.phases)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        elapsed = perf_counter() - self.start
+        _request_phases.reset(self.token)
+        if exc is not None:
+            self.status = getattr(exc, 'code', None) or 500
+        REQUESTS.inc(self.method, self.route, self.status)
+        REQUEST_SECONDS.observe(elapsed, self.method, self.route)
+        for name, seconds in self.phases.items():
+            if name is not _NESTED:
+                PHASE_SECONDS.observe(seconds, self.method, self.route, name)
+
+
+def instrumented_query(function):
+    """Times a db_queries function in db_query_duration_seconds and in the
+       database phase of the current request.
+    """
+    name = '%s.%s' % (function.__module__.replace('app.database.', ''),
+                      function.__name__)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with phase('database') as timer:
+            try:
+                return function(*args, **kwargs)
+            finally:
+                QUERY_SECONDS.observe(perf_counter() - timer.start, name)
+    return wrapper
+
+
+def timed_phase(name):
+    """Decorator form of ``phase``."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,53 @@
+"""Doctor photos as sent by clients: files of a multipart upload or, from
+older clients, base64 strings in the JSON body.
+"""
+import base64
+import binascii
+import re
+
+# Photos are served with their own content type only when it is one of
+# these, so an upload can't be served as HTML from the API origin.
+PHOTO_CONTENT_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp',
+                       'application/pdf'}
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+_DATA_URL = re.compile(r'data:([\w.+-]+/[\w.+-]+)?[^,]*,', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF8', 'image/gif'),
+    (b'%PDF', 'application/pdf'),
+)
+
+
+def photo_content_type(content_type, data=b''):
+    """Returns the allowed content type of a photo, or the one its first
+       bytes show when the declared one is missing or not allowed.
+    """
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in PHOTO_CONTENT_TYPES:
+        return content_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, sniffed in _SIGNATURES:
+        if data.startswith(signature):
+            return sniffed
+    return DEFAULT_CONTENT_TYPE
+
+
+def decode_photo(value):
+    """Returns the content type and bytes of a photo sent as a JSON string,
+       base64 or a base64 data URL. Other strings are kept as their bytes.
+    """
+    content_type = None
+    match = _DATA_URL.match(value)
+    encoded = value
+    if match:
+        content_type = match.group(1)
+        encoded = value[match.end():]
+    try:
+        data = base64.b64decode(_WHITESPACE.sub('', encoded), validate=True)
+    except (binascii.Error, ValueError):
+        return DEFAULT_CONTENT_TYPE, value.encode()
+    return photo_content_type(content_type, data), data
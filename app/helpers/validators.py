@@ -0,0 +1,151 @@
+"""Request schemas and argument parsers, built once at import and shared by
+the request handlers.
+"""
+import functools
+import re
+import threading
+
+from cerberus import Validator, errors
+from flask_restful import reqparse
+
+from app.helpers.metrics import phase
+
+EMAIL_REGEX = r'(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)'
+CELLPHONE_REGEX = '[0-9]{10}'
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(pattern):
+    # Cerberus anchors regex rules at the end before matching.
+    return re.compile(pattern if pattern.endswith('$') else pattern + '$')
+
+
+class PrecompiledValidator(Validator):
+    """Validator that compiles each regex rule once per process."""
+
+    def validate(self, *args, **kwargs):
+        with phase('validation'):
+            return super().validate(*args, **kwargs)
+
+    def _validate_regex(self, pattern, field, value):
+        """ {'type': 'string'} """
+        if not isinstance(value, str):
+            return
+        if not _compile(pattern).match(value):
+            self._error(field, errors.REGEX_MISMATCH)
+
+
+class CompiledSchema:
+    """A schema checked once, validated with one Validator per thread.
+
+       Validators keep the document and errors of their last validation, so
+       a thread reuses its own instead of building one per request.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._local = threading.local()
+        # Fails at import on an invalid schema.
+        self._local.validator = PrecompiledValidator(schema)
+
+    @property
+    def validator(self):
+        try:
+            return self._local.validator
+        except AttributeError:
+            self._local.validator = PrecompiledValidator(self.schema)
+            return self._local.validator
+
+
+DIAGNOSTIC_SCHEMA = CompiledSchema({
+    'patient_id': {'type': 'string', 'required': True},
+    'diagnose': {'type': 'string', 'required': True},
+    'doctor_id': {'type': 'string', 'required': True},
+    'report_id': {'type': 'string', 'required': True},
+    'conduct': {'type': 'string', 'required': True},
+    'risk': {'type': 'string', 'required': False, 'nullable': True,
+             'allowed': ['low', 'medium', 'high']}
+})
+
+DOCTOR_REGISTRATION_SCHEMA = CompiledSchema({
+    'cellphone': {'type': 'string', 'required': True, 'regex': CELLPHONE_REGEX},
+    'email': {'type': 'string', 'required': True, 'regex': EMAIL_REGEX},
+    'registered': {'type': 'boolean', 'required': True}
+})
+
+_DOCTOR_APPLICATION_FIELDS = {
+    'first_name': {'type': 'string', 'required': True},
+    'last_name': {'type': 'string', 'required': True},
+    'cellphone': {'type': 'string', 'required': True, 'regex': CELLPHONE_REGEX},
+    'email': {'type': 'string', 'required': True, 'regex': EMAIL_REGEX}
+}
+
+DOCTOR_APPLICATION_SCHEMA = CompiledSchema(dict(
+    _DOCTOR_APPLICATION_FIELDS,
+    professional_card_photo={'type': 'string', 'required': True},
+    official_id_photo={'type': 'string', 'required': True}
+))
+
+# Multipart applications send the photos as files, checked apart.
+DOCTOR_APPLICATION_FORM_SCHEMA = CompiledSchema(dict(_DOCTOR_APPLICATION_FIELDS))
+
+REPORT_SCHEMA = CompiledSchema({
+    'report_id': {'type': 'string', 'required': True},
+    'statuses': {
+        'type': 'list',
+        'required': True,
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'name': {'type': 'string', 'required': True},
+                'active': {'type': 'boolean', 'required': True}
+            }
+        }
+    }
+})
+
+FEEDBACK_SCHEMA = CompiledSchema({
+    'feedback': {'type': 'string', 'required': True}
+})
+
+# (name, required, help, choices) of the string arguments of the JSON bodies
+# parsed with reqparse.
+DIAGNOSTIC_ARGUMENTS = [
+    ('patient_id', True, 'ID of patient. (Required)', None),
+    ('diagnose', True, 'Diagnose of the patient', None),
+    ('doctor_id', True, 'ID of the doctor', None),
+    ('report_id', True, 'ID of the report', None),
+    ('conduct', True, 'Recommendation for the patient required', None),
+    ('risk', False, 'Risk of the patient required', (None, 'low', 'medium', 'high')),
+]
+
+APPOINTMENT_ARGUMENTS = [
+    ('patient_id', True, 'ID of patient. (Required)', None),
+    ('doctor_id', True, 'ID of the doctor', None),
+]
+
+
+class TimedRequestParser(reqparse.RequestParser):
+
+    def parse_args(self, *args, **kwargs):
+        with phase('validation'):
+            return super().parse_args(*args, **kwargs)
+
+
+def request_parser(arguments):
+    """Builds a RequestParser of string arguments. Parsers hold no request
+       state, so one instance serves every thread.
+    """
+    parser = TimedRequestParser()
+    for name, required, help, choices in arguments:
+        options = {'choices': choices} if choices is not None else {}
+        parser.add_argument(name, type=str, required=required, help=help,
+                            **options)
+    return parser
+
+
+diagnostic_parser = request_parser(DIAGNOSTIC_ARGUMENTS)
+
+appointment_parser = request_parser(APPOINTMENT_ARGUMENTS)
+appointment_parser.add_argument('informed_consent_accepted', type=bool,
+                                required=False)
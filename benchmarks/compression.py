@@ -0,0 +1,94 @@
+"""Times the compression of representative JSON responses with each
+available encoding and level, against the bytes it saves.
+
+    python benchmarks/compression.py --page-size 500
+
+br and zstd are measured when brotli and zstandard are installed. The
+"stream" rows compress the body in --stream-batch-size document chunks,
+flushing after each one as streamed responses do.
+"""
+import argparse
+import datetime as dt
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.helpers import json_provider
+from app.helpers.compression import ENCODERS, compressed_chunks
+from json_encoding import diagnostics_page
+
+LEVELS = {'gzip': (1, 6, 9), 'br': (1, 4, 6, 11), 'zstd': (1, 3, 9)}
+
+
+def doctor_applications_page(size):
+    now = dt.datetime.utcnow()
+    return {'code': 'Application found', 'next': 'x' * 80, 'message': [{
+        'first_name': random.choice(['Ana', 'Juan', 'María', 'Luis']),
+        'last_name': random.choice(['Gómez', 'Pérez', 'Rodríguez']),
+        'cellphone': '3%09d' % random.randrange(10 ** 9),
+        'email': 'doctor%d@example.com' % index,
+        'professional_card_photo': {'file_id': '%024x' % random.getrandbits(96),
+                                    'content_type': 'image/jpeg',
+                                    'length': random.randrange(10 ** 5, 10 ** 6)},
+        'official_id_photo': {'file_id': '%024x' % random.getrandbits(96),
+                              'content_type': 'image/jpeg',
+                              'length': random.randrange(10 ** 5, 10 ** 6)},
+        '_request_date': now - dt.timedelta(minutes=index),
+    } for index in range(size)]}
+
+
+def feedback_page(size):
+    now = dt.datetime.utcnow()
+    words = ('la', 'app', 'videollamada', 'doctor', 'muy', 'buena', 'lenta',
+             'se', 'cortó', 'gracias', 'atención', 'rápida')
+    return {'code': 'feedback found', 'message': [{
+        'feedback': ' '.join(random.choice(words)
+                             for _ in range(random.randrange(5, 40))),
+        '_feedback_date': now - dt.timedelta(minutes=index),
+    } for index in range(size)]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--stream-batch-size', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    dumps = json_provider.get_provider('auto').dumps
+    print('%-13s %-12s %6s %10s %10s %7s %10s %8s' % (
+        'page', 'encoding', 'level', 'bytes', 'saved', 'ratio', 'ms/page', 'MB/s'))
+    for page_name, build in (('applications', doctor_applications_page),
+                             ('diagnostics', diagnostics_page),
+                             ('feedback', feedback_page)):
+        page = build(args.page_size)
+        body = dumps(page)
+        documents = [dumps(document) for document in page['message']]
+        chunks = [b','.join(documents[index:index + args.stream_batch_size])
+                  for index in range(0, len(documents), args.stream_batch_size)]
+        print('%-13s %-12s %6s %10d' % (page_name, 'identity', '-', len(body)))
+
+        for name, encoder_class in ENCODERS.items():
+            if not encoder_class.available:
+                print('%-13s %-12s not installed, skipped' % (page_name, name))
+                continue
+            for level in LEVELS[name]:
+                encoder = encoder_class(level)
+                for mode, compress in (
+                        (name, lambda: encoder.compress(body)),
+                        (name + '/stream',
+                         lambda: b''.join(compressed_chunks(encoder, chunks)))):
+                    seconds = min(timeit.repeat(compress, number=1,
+                                                repeat=args.repeat))
+                    size = len(compress())
+                    print('%-13s %-12s %6d %10d %10d %7.3f %10.3f %8.1f' % (
+                        page_name, mode, level, size, len(body) - size,
+                        size / len(body), seconds * 1000,
+                        len(body) / seconds / 10 ** 6))
+
+
+if __name__ == '__main__':
+    main()
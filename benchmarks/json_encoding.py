@@ -0,0 +1,72 @@
+"""Times the encoding of a page of appointments and of diagnostics with
+Flask's jsonify (the encoder responses used before app.helpers.json_provider)
+and with each JSON provider.
+
+    python benchmarks/json_encoding.py --page-size 500
+"""
+import argparse
+import datetime as dt
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask, jsonify
+
+from app.helpers import json_provider
+
+
+def appointments_page(size):
+    now = dt.datetime.utcnow()
+    return {'code': 'appointments found', 'next': 'x' * 80, 'message': [{
+        'patient_id': 'patient-%d' % random.randrange(10 ** 6),
+        'doctor_id': 'doctor-%d' % random.randrange(10 ** 3),
+        'videocall_code': '%06d' % random.randrange(10 ** 6),
+        'informed_consent_accepted': random.random() < 0.5,
+        '_appointment_creation_date': now - dt.timedelta(minutes=index),
+    } for index in range(size)]}
+
+
+def diagnostics_page(size):
+    now = dt.datetime.utcnow()
+    return {'code': 'diagnostics found', 'next': 'x' * 80, 'message': [{
+        'patient_id': 'patient-%d' % random.randrange(10 ** 6),
+        'doctor_id': 'doctor-%d' % random.randrange(10 ** 3),
+        'report_id': 'report-%d' % random.randrange(10 ** 4),
+        'diagnose': 'Síntomas leves, sin fiebre. ' * 4,
+        'conduct': 'Aislamiento preventivo y control en 48 horas',
+        'risk': random.choice(['low', 'medium', 'high']),
+        '_diagnostic_date': now - dt.timedelta(minutes=index),
+    } for index in range(size)]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    encoders = [('jsonify', lambda page: jsonify(page).get_data())]
+    for name in ('stdlib', 'orjson'):
+        try:
+            encoders.append((name, json_provider.get_provider(name).dumps))
+        except ValueError:
+            print('%s is not installed, skipped' % name)
+
+    print('%-12s %-10s %12s %12s' % ('page', 'encoder', 'ms/page', 'bytes'))
+    with app.app_context():
+        for page_name, build in (('appointments', appointments_page),
+                                 ('diagnostics', diagnostics_page)):
+            page = build(args.page_size)
+            for name, encode in encoders:
+                seconds = min(timeit.repeat(lambda: encode(page), number=1,
+                                            repeat=args.repeat))
+                print('%-12s %-10s %12.3f %12d' % (
+                    page_name, name, seconds * 1000, len(encode(page))))
+
+
+if __name__ == '__main__':
+    main()
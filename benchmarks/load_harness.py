@@ -0,0 +1,606 @@
+"""End-to-end load harness: seeds a database with realistic volumes, signs
+its own tokens with a local JWKS and drives a mixed workload across every
+resource, then reports throughput and p50/p95/p99 latency per endpoint.
+
+Against a local mongod and a server started by you:
+
+    python benchmarks/load_harness.py seed --mongo-uri mongodb://localhost:27017/
+    AUTH0_JWKS_URL=http://127.0.0.1:8765/.well-known/jwks.json \\
+        AUTH0_DOMAIN=load-harness.local API_AUDIENCE=load-harness \\
+        gunicorn -w 4 -b :8000 wsgi
+    python benchmarks/load_harness.py run --url http://localhost:8000
+
+Fully in-process, with mongomock standing in for Mongo (small volumes only,
+the numbers are only comparable with other in-process runs):
+
+    python benchmarks/load_harness.py run --in-process --stand-in --seed \\
+        --diagnostics 20000 --appointments 20000 --patients 2000 \\
+        --doctors 50 --reports 500 --feedback 1000
+
+Each run is saved to benchmarks/results/<commit>.json and compared with the
+previous result, so regressions between commits are visible. A run with
+5xx responses is not saved and exits with an error.
+"""
+import argparse
+import asyncio
+import base64
+import datetime as dt
+import glob
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import rsa
+from jose import jwt
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+RESULTS = os.path.join(BENCHMARKS, 'results')
+sys.path.insert(0, ROOT)
+
+RISKS = ['low', 'medium', 'high']
+STATUSES = ['fever', 'cough', 'headache', 'fatigue', 'shortness_of_breath']
+
+
+# Data --------------------------------------------------------------------
+
+def _patient(index):
+    return 'patient-%07d' % index
+
+
+def _doctor(index):
+    return 'doctor-%05d' % index
+
+
+def _report(index):
+    return 'report-%06d' % index
+
+
+def _diagnostic_key(volumes, index):
+    # Distinct (patient, report) pairs for index < patients * reports, as
+    # the unique index on report_id, patient_id and doctor_id requires.
+    patient = index % volumes.patients
+    report = (index // volumes.patients) % volumes.reports
+    return _patient(patient), _doctor(patient % volumes.doctors), _report(report)
+
+
+def _diagnostic(rng, volumes, index):
+    patient_id, doctor_id, report_id = _diagnostic_key(volumes, index)
+    return {
+        'patient_id': patient_id,
+        'doctor_id': doctor_id,
+        'report_id': report_id,
+        'diagnose': rng.choice(['Síntomas leves, sin fiebre.',
+                                'Fiebre y tos persistente por tres días.',
+                                'Dificultad respiratoria moderada.']),
+        'conduct': rng.choice(['Aislamiento preventivo',
+                               'Control en 48 horas',
+                               'Remitir a urgencias']),
+        'risk': rng.choice(RISKS)
+    }
+
+
+def _statuses(rng):
+    return [{'name': name, 'active': rng.random() < 0.3} for name in STATUSES]
+
+
+def _doctor_contact(index):
+    return '3%09d' % index, 'doctor%d@example.com' % index
+
+
+def _past(rng, now):
+    return now - dt.timedelta(seconds=rng.randrange(365 * 24 * 3600))
+
+
+def _seed_documents(kind, volumes, rng, now):
+    if kind == 'diagnostic':
+        for index in range(volumes.diagnostics):
+            document = _diagnostic(rng, volumes, index)
+            document['_diagnostic_date'] = document['_last_update'] = _past(rng, now)
+            yield document
+    elif kind == 'appointment':
+        for index in range(volumes.appointments):
+            yield {
+                'patient_id': _patient(rng.randrange(volumes.patients)),
+                'doctor_id': _doctor(rng.randrange(volumes.doctors)),
+                # Longer than the generated codes, so they never collide.
+                'videocall_code': 's%09d' % index,
+                'informed_consent_accepted': rng.random() < 0.6,
+                '_appointment_creation_date': _past(rng, now)
+            }
+    elif kind == 'doctor':
+        photo = base64.b64encode(os.urandom(volumes.photo_bytes)).decode()
+        for index in range(volumes.doctors):
+            cellphone, email = _doctor_contact(index)
+            yield {
+                'first_name': 'Nombre%d' % index, 'last_name': 'Apellido%d' % index,
+                'cellphone': cellphone, 'email': email,
+                'professional_card_photo': photo, 'official_id_photo': photo,
+                'registered': rng.random() < 0.7, '_request_date': _past(rng, now)
+            }
+    elif kind == 'report':
+        for index in range(volumes.reports):
+            date = _past(rng, now)
+            yield {'report_id': _report(index), 'statuses': _statuses(rng),
+                   '_report_creation_date': date, '_last_update': date}
+    elif kind == 'feedback':
+        for index in range(volumes.feedback):
+            yield {'feedback': 'Sugerencia %d sobre la aplicación' % index,
+                   '_feedback_date': _past(rng, now)}
+
+
+def seed(db, volumes, batch_size=10000):
+    """Drops and refills the collections, then builds the indexes and the
+       accepted consent counter the app expects.
+    """
+    from app.database.db_indexes import ensure_indexes
+    from app.database.db_queries_appointment import reconcile_summary
+
+    if volumes.diagnostics > volumes.patients * volumes.reports:
+        raise SystemExit('--diagnostics must be at most --patients * --reports')
+
+    rng, now = random.Random(volumes.random_seed), dt.datetime.utcnow()
+    for kind in ('diagnostic', 'appointment', 'doctor', 'report', 'feedback'):
+        db[kind].drop()
+        batch, inserted, start = [], 0, time.monotonic()
+        for document in _seed_documents(kind, volumes, rng, now):
+            batch.append(document)
+            if len(batch) == batch_size:
+                db[kind].insert_many(batch, ordered=False)
+                inserted += len(batch)
+                batch = []
+        if batch:
+            db[kind].insert_many(batch, ordered=False)
+            inserted += len(batch)
+        print('seeded %9d %-12s in %.1fs' % (inserted, kind,
+                                              time.monotonic() - start))
+
+    ensure_indexes(db)
+    reconcile_summary(db)
+
+
+# Auth --------------------------------------------------------------------
+
+def _b64(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+class LocalIssuer:
+    """Signs RS256 tokens for the app and serves the matching JWKS."""
+
+    def __init__(self, domain, audience):
+        self.domain = domain
+        self.audience = audience
+        # A new kid per run makes a running server fetch the new key.
+        self.kid = 'load-harness-%d' % int(time.time())
+        public_key, private_key = rsa.newkeys(2048)
+        self.private_pem = private_key.save_pkcs1().decode()
+        self.jwks = {'keys': [{'kty': 'RSA', 'kid': self.kid, 'use': 'sig',
+                               'n': _b64(public_key.n), 'e': _b64(public_key.e)}]}
+
+    def token(self, lifetime):
+        now = int(time.time())
+        return jwt.encode({'iss': 'https://%s/' % self.domain,
+                           'aud': self.audience, 'sub': 'load-harness',
+                           'iat': now, 'exp': now + lifetime},
+                          self.private_pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def serve_jwks(self, port):
+        """Serves the key set on 127.0.0.1:``port`` from a daemon thread.
+           Returns its URL.
+        """
+        body = json.dumps(self.jwks).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:%d/.well-known/jwks.json' % server.server_port
+
+
+# Workload ----------------------------------------------------------------
+
+def _json(body):
+    return json.dumps(body).encode()
+
+
+def _put_diagnostic(rng, volumes):
+    if rng.random() < 0.8:
+        index = rng.randrange(volumes.diagnostics)
+    else:
+        index = rng.randrange(volumes.diagnostics, volumes.patients * volumes.reports)
+    return 'PUT', '/diagnostic', _json(_diagnostic(rng, volumes, index))
+
+
+def _put_diagnostic_batch(rng, volumes):
+    return 'PUT', '/diagnostic/batch', _json([
+        _diagnostic(rng, volumes, rng.randrange(volumes.diagnostics))
+        for _ in range(50)])
+
+
+def _patch_doctor(rng, volumes):
+    cellphone, email = _doctor_contact(rng.randrange(volumes.doctors))
+    return 'PATCH', '/doctor', _json({'cellphone': cellphone, 'email': email,
+                                      'registered': rng.random() < 0.5})
+
+
+def _post_doctor(rng, volumes):
+    photo = base64.b64encode(os.urandom(volumes.photo_bytes)).decode()
+    cellphone, email = _doctor_contact(volumes.doctors + rng.randrange(10 ** 8))
+    return 'POST', '/doctor', _json({
+        'first_name': 'Nuevo', 'last_name': 'Doctor', 'cellphone': cellphone,
+        'email': email, 'professional_card_photo': photo,
+        'official_id_photo': photo})
+
+
+# (endpoint, weight, request builder returning method, path and body)
+WORKLOAD = [
+    ('GET /diagnostic?patient_id', 20, lambda rng, v: (
+        'GET', '/diagnostic?patient_id=%s' % _patient(rng.randrange(v.patients)), None)),
+    ('GET /diagnostic?patient_id&limit', 10, lambda rng, v: (
+        'GET', '/diagnostic?patient_id=%s&limit=20' % _patient(rng.randrange(v.patients)), None)),
+    ('GET /diagnostic?patient_id&last_conduct', 5, lambda rng, v: (
+        'GET', '/diagnostic?patient_id=%s&last_conduct=1' % _patient(rng.randrange(v.patients)), None)),
+    ('GET /diagnostic?report_id&limit', 5, lambda rng, v: (
+        'GET', '/diagnostic?report_id=%s&limit=50' % _diagnostic_key(
+            v, rng.randrange(v.diagnostics))[2], None)),
+    ('GET /diagnostic?patient_ids', 5, lambda rng, v: (
+        'GET', '/diagnostic?patient_ids=%s' % ','.join(
+            _patient(rng.randrange(v.patients)) for _ in range(20)), None)),
+    ('PUT /diagnostic', 10, _put_diagnostic),
+    ('PUT /diagnostic/batch', 1, _put_diagnostic_batch),
+    ('POST /appointment', 5, lambda rng, v: (
+        'POST', '/appointment', _json({
+            'patient_id': _patient(rng.randrange(v.patients)),
+            'doctor_id': _doctor(rng.randrange(v.doctors)),
+            'informed_consent_accepted': rng.random() < 0.6}))),
+    ('GET /appointment?patient_id&limit', 8, lambda rng, v: (
+        'GET', '/appointment?patient_id=%s&limit=20' % _patient(rng.randrange(v.patients)), None)),
+    ('GET /appointment?doctor_id&limit', 4, lambda rng, v: (
+        'GET', '/appointment?doctor_id=%s&limit=20' % _doctor(rng.randrange(v.doctors)), None)),
+    ('GET /appointment?summary', 5, lambda rng, v: (
+        'GET', '/appointment?summary=1', None)),
+    ('PATCH /appointment', 3, lambda rng, v: (
+        'PATCH', '/appointment', _json({
+            'videocall_code': 's%09d' % rng.randrange(v.appointments),
+            'informed_consent_accepted': rng.random() < 0.5}))),
+    ('GET /doctor?limit', 2, lambda rng, v: ('GET', '/doctor?limit=20', None)),
+    ('POST /doctor', 1, _post_doctor),
+    ('PATCH /doctor', 1, _patch_doctor),
+    ('PUT /report', 3, lambda rng, v: (
+        'PUT', '/report', _json({'report_id': _report(rng.randrange(v.reports)),
+                                 'statuses': _statuses(rng)}))),
+    ('GET /report', 8, lambda rng, v: (
+        'GET', '/report?report_id=%s' % _report(rng.randrange(v.reports)), None)),
+    ('POST /feedback', 2, lambda rng, v: (
+        'POST', '/feedback', _json({'feedback': 'Sugerencia de carga'}))),
+    ('GET /feedback?limit', 1, lambda rng, v: ('GET', '/feedback?limit=20', None)),
+    ('GET /health-check', 1, lambda rng, v: ('GET', '/health-check', None)),
+]
+
+
+async def send_request(reader, writer, host, path, headers, method='GET',
+                       body=None):
+    """Sends one request, with ``body`` as JSON bytes, and reads the
+       response. Returns the status and whether the server keeps the
+       connection open.
+    """
+    lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % host]
+    lines += ['%s: %s' % header for header in headers.items()]
+    if body is not None:
+        lines += ['Content-Type: application/json',
+                  'Content-Length: %d' % len(body)]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + (body or b''))
+    await writer.drain()
+
+    status_line = await reader.readline()
+    keep_alive = status_line.startswith(b'HTTP/1.1')
+    length, chunked = None, False
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode().partition(':')
+        name, value = name.lower(), value.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'transfer-encoding' and 'chunked' in value:
+            chunked = True
+        elif name == 'connection':
+            keep_alive = value == 'keep-alive' or (keep_alive and value != 'close')
+
+    if chunked:
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            await reader.readexactly(size + 2)
+            if not size:
+                break
+    elif length is not None:
+        await reader.readexactly(length)
+    else:
+        await reader.read()
+        keep_alive = False
+
+    return int(status_line.split()[1]), keep_alive
+
+
+async def _worker(base_url, headers, volumes, deadline, rng, latencies, statuses):
+    url = urlsplit(base_url)
+    cum_weights, total = [], 0
+    for _, weight, _ in WORKLOAD:
+        total += weight
+        cum_weights.append(total)
+    connection = None
+    try:
+        while time.monotonic() < deadline:
+            endpoint, _, build = rng.choices(WORKLOAD, cum_weights=cum_weights)[0]
+            method, path, body = build(rng, volumes)
+            start = time.perf_counter()
+            if connection is None:
+                connection = await asyncio.open_connection(url.hostname,
+                                                           url.port or 80)
+            status, keep_alive = await send_request(*connection, url.netloc,
+                                                    path, headers, method, body)
+            latencies.setdefault(endpoint, []).append(time.perf_counter() - start)
+            counts = statuses.setdefault(endpoint, {})
+            counts[status] = counts.get(status, 0) + 1
+            if not keep_alive:
+                connection[1].close()
+                connection = None
+    finally:
+        if connection is not None:
+            connection[1].close()
+
+
+async def run_workload(base_url, token, volumes, concurrency, duration, seed=0):
+    """Runs the mixed workload. Returns the latencies in seconds and the
+       count of each status, by endpoint.
+    """
+    latencies, statuses = {}, {}
+    headers = {'Authorization': 'Bearer ' + token}
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*[
+        _worker(base_url, headers, volumes, deadline, random.Random(seed + worker),
+                latencies, statuses)
+        for worker in range(concurrency)])
+    return latencies, statuses
+
+
+def start_in_process(args, issuer, jwks_url):
+    """Imports the Flask app configured for the harness and serves it from
+       a daemon thread. Returns its URL and database.
+    """
+    os.environ.update(MONGO_URI=args.mongo_uri, DB_NAME=args.db_name,
+                      AUTH0_DOMAIN=issuer.domain, API_AUDIENCE=issuer.audience,
+                      AUTH0_JWKS_URL=jwks_url)
+    os.environ.setdefault('ALGORITHMS', 'RS256')
+    os.environ.setdefault('VIDEOCALL_CODE_SIZE', '6')
+    if args.stand_in:
+        import mongomock
+        import mongomock.gridfs
+        from app.database import db_setup
+        # Lets gridfs take mongomock databases, for the doctor photos.
+        mongomock.gridfs.enable_gridfs_integration()
+        db_setup.MongoClient = lambda *args, **kwargs: mongomock.MongoClient()
+
+    from werkzeug.serving import make_server
+    from app import application
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, application.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:%d' % server.server_port, application.db
+
+
+# Results -----------------------------------------------------------------
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies, duration):
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / duration,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def commit_label():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=ROOT).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain',
+                                         '--untracked-files=no'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def summarize_run(latencies, statuses, duration):
+    endpoints = {}
+    for endpoint in sorted(latencies):
+        endpoints[endpoint] = summarize(latencies[endpoint], duration)
+        endpoints[endpoint]['statuses'] = {str(status): count for status, count
+                                           in sorted(statuses[endpoint].items())}
+    everything = [latency for values in latencies.values() for latency in values]
+    return endpoints, summarize(everything, duration) if everything else {}
+
+
+def server_errors(statuses):
+    """Returns the count of 5xx responses of each endpoint that had any."""
+    errors = {}
+    for endpoint, counts in statuses.items():
+        count = sum(number for status, number in counts.items() if status >= 500)
+        if count:
+            errors[endpoint] = count
+    return errors
+
+
+def print_results(result, baseline=None):
+    base = baseline['endpoints'] if baseline else {}
+    print('%-42s %8s %9s %9s %9s %9s  %s' % ('endpoint', 'requests', 'req/s',
+                                            'p50 ms', 'p95 ms', 'p99 ms',
+                                            'statuses'))
+    rows = sorted(result['endpoints'].items()) + [('total', result['total'])]
+    for endpoint, row in rows:
+        line = '%-42s %8d %9.1f %9.2f %9.2f %9.2f  %s' % (
+            endpoint, row['requests'], row['rps'], row['p50_ms'], row['p95_ms'],
+            row['p99_ms'], row.get('statuses', ''))
+        previous = base.get(endpoint) or (baseline or {}).get(endpoint)
+        if previous and previous['p95_ms']:
+            line += '  p95 %+.0f%%' % (100 * (row['p95_ms'] / previous['p95_ms'] - 1))
+        print(line)
+
+
+def latest_result(exclude):
+    paths = [path for path in glob.glob(os.path.join(RESULTS, '*.json'))
+             if os.path.abspath(path) != os.path.abspath(exclude)]
+    if not paths:
+        return None
+    with open(max(paths, key=os.path.getmtime)) as result_file:
+        return json.load(result_file)
+
+
+def save_result(result, label):
+    os.makedirs(RESULTS, exist_ok=True)
+    path = os.path.join(RESULTS, label + '.json')
+    baseline = latest_result(exclude=path)
+    with open(path, 'w') as result_file:
+        json.dump(result, result_file, indent=2, sort_keys=True)
+    return path, baseline
+
+
+# Commands ----------------------------------------------------------------
+
+def _volume_arguments(parser):
+    group = parser.add_argument_group('volumes, the same for seed and run')
+    group.add_argument('--diagnostics', type=int, default=2000000)
+    group.add_argument('--appointments', type=int, default=1000000)
+    group.add_argument('--patients', type=int, default=200000)
+    group.add_argument('--doctors', type=int, default=2000)
+    group.add_argument('--reports', type=int, default=50000)
+    group.add_argument('--feedback', type=int, default=50000)
+    group.add_argument('--photo-bytes', type=int, default=2048)
+    group.add_argument('--random-seed', type=int, default=1)
+
+
+def command_seed(args):
+    from pymongo import MongoClient
+    seed(MongoClient(args.mongo_uri)[args.db_name], args)
+
+
+def command_run(args):
+    issuer = LocalIssuer(args.domain, args.audience)
+    jwks_url = issuer.serve_jwks(args.jwks_port)
+    base_url = args.url
+    if args.in_process:
+        base_url, db = start_in_process(args, issuer, jwks_url)
+        if args.seed:
+            seed(db, args)
+    elif args.seed:
+        command_seed(args)
+
+    print('%s workload on %s, %d connections for %ss' % (
+        'in-process' if args.in_process else 'remote', base_url,
+        args.concurrency, args.duration))
+    latencies, statuses = asyncio.get_event_loop().run_until_complete(
+        run_workload(base_url, issuer.token(int(args.duration) + 3600), args,
+                     args.concurrency, args.duration))
+    endpoints, total = summarize_run(latencies, statuses, args.duration)
+    label = args.label or commit_label()
+    result = {
+        'label': label,
+        'date': dt.datetime.utcnow().isoformat() + 'Z',
+        'mode': 'in-process' + (' stand-in' if args.stand_in else '')
+                if args.in_process else 'remote',
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'volumes': {name: getattr(args, name) for name in (
+            'diagnostics', 'appointments', 'patients', 'doctors', 'reports',
+            'feedback')},
+        'endpoints': endpoints,
+        'total': total
+    }
+    errors = server_errors(statuses)
+    if errors:
+        # Latencies of failed requests aren't comparable, don't keep them.
+        print_results(result)
+        raise SystemExit('not saved, server errors: %s' % ', '.join(
+            '%s %d' % (endpoint, count) for endpoint, count in sorted(errors.items())))
+    path, baseline = save_result(result, label)
+    if baseline:
+        print('p95 compared with %s (%s)' % (baseline['label'], baseline['date']))
+    print_results(result, baseline)
+    print('saved %s' % os.path.relpath(path, ROOT))
+
+
+def command_compare(args):
+    with open(args.baseline) as baseline_file, open(args.result) as result_file:
+        baseline, result = json.load(baseline_file), json.load(result_file)
+    print('%s compared with %s' % (result['label'], baseline['label']))
+    print_results(result, baseline)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    seed_parser = commands.add_parser('seed', help='fill a database')
+    run_parser = commands.add_parser('run', help='drive the mixed workload')
+    for command_parser in (seed_parser, run_parser):
+        command_parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/')
+        command_parser.add_argument('--db-name', default='load_harness')
+        _volume_arguments(command_parser)
+
+    run_parser.add_argument('--url', default='http://localhost:8000')
+    run_parser.add_argument('--in-process', action='store_true',
+                            help='serve the Flask app from this process')
+    run_parser.add_argument('--stand-in', action='store_true',
+                            help='use mongomock instead of --mongo-uri (with --in-process)')
+    run_parser.add_argument('--seed', action='store_true',
+                            help='seed the database before the run')
+    run_parser.add_argument('--domain', default='load-harness.local',
+                            help='AUTH0_DOMAIN of the server')
+    run_parser.add_argument('--audience', default='load-harness',
+                            help='API_AUDIENCE of the server')
+    run_parser.add_argument('--jwks-port', type=int, default=8765)
+    run_parser.add_argument('--concurrency', type=int, default=50)
+    run_parser.add_argument('--duration', type=float, default=60)
+    run_parser.add_argument('--label', help='results file name (default: commit)')
+
+    compare_parser = commands.add_parser('compare', help='compare two results')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('result')
+
+    args = parser.parse_args()
+    if args.command == 'run' and args.stand_in and not args.in_process:
+        parser.error('--stand-in requires --in-process')
+    {'seed': command_seed, 'run': command_run,
+     'compare': command_compare}[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import base64
+import os
+import time
+
+import mongomock
+import pytest
+import rsa
+from jose import jwt
+
+DOMAIN = 'tests.local'
+AUDIENCE = 'tests'
+KID = 'tests'
+
+
+def _b64(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+@pytest.fixture(scope='session')
+def signing_key():
+    public_key, private_key = rsa.newkeys(1024)
+    jwk = {'kty': 'RSA', 'kid': KID, 'use': 'sig',
+           'n': _b64(public_key.n), 'e': _b64(public_key.e)}
+    return jwk, private_key.save_pkcs1().decode()
+
+
+@pytest.fixture(scope='session')
+def application(signing_key):
+    """The Flask app on a mongomock database, trusting ``signing_key``."""
+    os.environ.update(MONGO_URI='mongodb://localhost', DB_NAME='tests',
+                      AUTH0_DOMAIN=DOMAIN, API_AUDIENCE=AUDIENCE,
+                      ALGORITHMS='RS256', VIDEOCALL_CODE_SIZE='6')
+    from app.database import db_setup
+    from app.helpers import auth
+
+    client = mongomock.MongoClient()
+    db_setup.MongoClient = lambda *args, **kwargs: client
+    auth.JWKSStore._fetch = lambda self: {KID: signing_key[0]}
+
+    from app import application
+    from app.database.db_indexes import ensure_indexes
+    ensure_indexes(application.db)
+    return application
+
+
+@pytest.fixture
+def client(application):
+    return application.app.test_client()
+
+
+@pytest.fixture
+def db(application):
+    yield application.db
+    for name in application.db.list_collection_names():
+        application.db[name].delete_many({})
+
+
+@pytest.fixture(scope='session')
+def auth_headers(signing_key):
+    now = int(time.time())
+    token = jwt.encode({'iss': 'https://%s/' % DOMAIN, 'aud': AUDIENCE,
+                        'sub': 'tests', 'iat': now, 'exp': now + 3600},
+                       signing_key[1], algorithm='RS256',
+                       headers={'kid': KID})
+    return {'Authorization': 'Bearer ' + token}
@@ -0,0 +1,15 @@
+def test_large_request_is_refused_before_reading(client, application):
+    limit = application.app.config['MAX_CONTENT_LENGTH']
+
+    response = client.post('/doctor', data=b'x' * (limit + 1),
+                           content_type='application/json')
+
+    assert response.status_code == 413
+    assert response.get_json()['code'] == 'request too large'
+
+
+def test_request_within_limit_is_handled(client, auth_headers):
+    response = client.post('/feedback', data=b'{', headers=auth_headers,
+                           content_type='application/json')
+
+    assert response.status_code == 400
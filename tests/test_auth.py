@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+from app.helpers.auth import JWKSStore, JWKSUnavailable
+
+KEY = {"kty": "RSA", "kid": "a", "use": "sig", "n": "n", "e": "AQAB"}
+
+
+class StubStore(JWKSStore):
+    """JWKSStore whose fetches return ``results`` in turn, raising the
+       exceptions among them, and are counted in ``fetches``.
+    """
+
+    def __init__(self, *results, **kwargs):
+        super().__init__("https://issuer.test/jwks.json", **kwargs)
+        self.results = list(results)
+        self.fetches = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def _fetch(self):
+        self.fetches += 1
+        self.release.wait(5)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return dict(result)
+
+
+def test_concurrent_first_fetch_is_single_flight():
+    store = StubStore({"a": KEY})
+    store.release.clear()
+    found = []
+
+    def get_key():
+        found.append(store.get_key("a"))
+
+    threads = [threading.Thread(target=get_key) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    store.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert store.fetches == 1
+    assert found == [(KEY, 1)] * 8
+
+
+def test_failed_first_fetch_fails_fast_until_retry_interval():
+    store = StubStore(OSError("unreachable"), {"a": KEY},
+                      min_refresh_interval=60)
+
+    with pytest.raises(OSError):
+        store.get_key("a")
+    for _ in range(3):
+        with pytest.raises(JWKSUnavailable):
+            store.get_key("a")
+        with pytest.raises(JWKSUnavailable):
+            store.check()
+
+    assert store.fetches == 1
+
+
+def test_unknown_kid_refresh_is_rate_limited():
+    store = StubStore({"a": KEY}, {"a": KEY}, min_refresh_interval=60)
+
+    assert store.get_key("a") == (KEY, 1)
+    for _ in range(3):
+        assert store.get_key("bogus") == (None, 1)
+
+    assert store.fetches == 1
+
+
+def test_unknown_kid_refreshes_once_interval_passed():
+    rotated = dict(KEY, kid="b")
+    store = StubStore({"a": KEY}, {"a": KEY, "b": rotated},
+                      min_refresh_interval=0)
+
+    assert store.get_key("a") == (KEY, 1)
+    assert store.get_key("b") == (rotated, 2)
+    assert store.fetches == 2
+
+
+def test_stale_keys_served_when_refresh_fails():
+    store = StubStore({"a": KEY}, OSError("unreachable"),
+                      OSError("unreachable"), ttl=0, min_refresh_interval=0)
+
+    assert store.get_key("a") == (KEY, 1)
+    assert store.get_key("a") == (KEY, 1)
+    assert store.check()["keys"] == 1
+    assert store.fetches == 3
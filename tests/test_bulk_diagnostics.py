@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from app.database.db_queries_diagnostic import post_diagnostics
+
+
+def diagnostic(n):
+    return {'patient_id': 'p%d' % n, 'doctor_id': 'd1', 'report_id': 'r1',
+            'conduct': 'rest', 'diagnose': 'flu'}
+
+
+class FakeDiagnostics:
+    """Collection answering bulk writes with ``details``, raised as a
+       BulkWriteError when they have write errors, and the one-by-one
+       retries with ``retries`` in turn.
+    """
+
+    def __init__(self, details, retries=()):
+        self.details = dict({'upserted': []}, **details)
+        self.retries = list(retries)
+        self.retried = []
+
+    def bulk_write(self, operations, ordered=True):
+        assert not ordered
+        if self.details.get('writeErrors'):
+            raise BulkWriteError(self.details)
+        return SimpleNamespace(bulk_api_result=self.details)
+
+    def update_one(self, key, changes):
+        self.retried.append(key['patient_id'])
+        retry = self.retries.pop(0)
+        if isinstance(retry, Exception):
+            raise retry
+        return SimpleNamespace(matched_count=retry)
+
+
+def statuses(collection, n):
+    return [(status['index'], status['status'], status.get('error'))
+            for status in post_diagnostics({'diagnostic': collection},
+                                           [diagnostic(i) for i in range(n)])]
+
+
+def test_inserted_and_updated():
+    collection = FakeDiagnostics({'upserted': [{'index': 0}, {'index': 2}]})
+
+    assert statuses(collection, 3) == [(0, 'inserted', None),
+                                       (1, 'updated', None),
+                                       (2, 'inserted', None)]
+
+
+def test_write_errors_keep_their_index():
+    collection = FakeDiagnostics({
+        'upserted': [{'index': 2}],
+        'writeErrors': [{'index': 1, 'code': 121, 'errmsg': 'invalid'}]})
+
+    assert statuses(collection, 3) == [(0, 'updated', None),
+                                       (1, 'error', 'invalid'),
+                                       (2, 'inserted', None)]
+    assert collection.retried == []
+
+
+def test_duplicate_key_is_retried_as_update():
+    collection = FakeDiagnostics({
+        'upserted': [{'index': 0}],
+        'writeErrors': [{'index': 1, 'code': 11000, 'errmsg': 'duplicate'}]},
+        retries=[1])
+
+    assert statuses(collection, 2) == [(0, 'inserted', None),
+                                       (1, 'updated', None)]
+    assert collection.retried == ['p1']
+
+
+def test_failed_retry_is_an_error():
+    collection = FakeDiagnostics({
+        'writeErrors': [{'index': 0, 'code': 11000, 'errmsg': 'duplicate'},
+                        {'index': 1, 'code': 11000, 'errmsg': 'duplicate'}]},
+        retries=[OperationFailure('timed out'), 0])
+
+    assert statuses(collection, 2) == [(0, 'error', 'timed out'),
+                                       (1, 'error', 'duplicate')]
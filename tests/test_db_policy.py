@@ -0,0 +1,155 @@
+import io
+
+import pytest
+from pymongo import MongoClient, ReadPreference
+from pymongo.write_concern import WriteConcern
+
+from app.database import (db_queries_appointment, db_queries_diagnostic,
+                          db_queries_doctors, db_queries_feedback,
+                          db_queries_report)
+from app.database.db_policy import (PolicyCollection, PolicyDatabase,
+                                    query_policies)
+
+MAX_TIME_MS = 500
+WRITE_TIMEOUT_MS = 2000
+
+PATIENT = {'patient_id': 'p1', 'doctor_id': 'd1', 'report_id': 'r1',
+           'conduct': 'rest', 'diagnose': 'flu'}
+
+# Query functions and arguments reaching their first collection.
+QUERIES = [
+    ('secondary_read', db_queries_feedback.get_feedback, ()),
+    ('secondary_read', db_queries_doctors.get_doctor_application, ()),
+    ('secondary_read', db_queries_appointment.get_summary, ()),
+    ('primary_read', db_queries_appointment.get_appointment, ()),
+    ('primary_read', db_queries_diagnostic.get_patient_id, ()),
+    ('primary_read', db_queries_diagnostic.get_diagnostics_version, ()),
+    ('primary_read', db_queries_diagnostic.get_last_conducts, (['p1'],)),
+    ('primary_read', db_queries_report.get_report_id, ('r1',)),
+    ('primary_read', db_queries_report.get_report_last_update, ('r1',)),
+    ('acknowledged_write', db_queries_feedback.post_feedback, ({},)),
+    ('acknowledged_write', db_queries_feedback.post_feedback_batch, ([{}],)),
+    ('majority_write', db_queries_appointment.post_appointment,
+     ({'informed_consent_accepted': False}, 6)),
+    ('majority_write', db_queries_appointment.modify_appointment,
+     (True, 'abc123')),
+    ('majority_write', db_queries_appointment.reconcile_summary, ()),
+    ('majority_write', db_queries_appointment.claim_summary_reconciliation,
+     (60,)),
+    ('majority_write', db_queries_diagnostic.post_patient_id, (PATIENT,)),
+    ('majority_write', db_queries_diagnostic.post_diagnostics, ([PATIENT],)),
+    ('majority_write', db_queries_doctors.post_doctor_id, ({},)),
+    ('majority_write', db_queries_doctors.modify_doctor,
+     ('5550000', 'a@b.c', True)),
+    ('majority_write', db_queries_report.create_replace_report,
+     ({'report_id': 'r1', 'statuses': []},)),
+]
+
+
+class Captured(Exception):
+
+    def __init__(self, collection):
+        super().__init__(collection)
+        self.collection = collection
+
+
+class CapturingDatabase(PolicyDatabase):
+    """PolicyDatabase stopping the query at the first collection it hands."""
+
+    def __getitem__(self, name):
+        raise Captured(super().__getitem__(name))
+
+
+@pytest.fixture
+def database():
+    client = MongoClient(connect=False)
+    yield CapturingDatabase(client['policy_test'], query_policies(
+        max_time_ms=MAX_TIME_MS, max_staleness=90,
+        write_timeout_ms=WRITE_TIMEOUT_MS))
+    client.close()
+
+
+def collection_of(query, database, args):
+    with pytest.raises(Captured) as captured:
+        if query is db_queries_diagnostic.post_patient_id:
+            query(*args, database)
+        else:
+            query(database, *args)
+    return captured.value.collection
+
+
+@pytest.mark.parametrize('policy, query, args', QUERIES,
+                         ids=[query.__name__ for _, query, _ in QUERIES])
+def test_query_applies_declared_policy(database, policy, query, args):
+    collection = collection_of(query, database, args)
+
+    assert isinstance(collection, PolicyCollection)
+    assert collection.max_time_ms == MAX_TIME_MS
+    collection = collection.collection
+    if policy == 'secondary_read':
+        assert collection.read_preference.mode == \
+            ReadPreference.SECONDARY_PREFERRED.mode
+        assert collection.read_preference.max_staleness == 90
+        assert collection.read_concern.level == 'local'
+    else:
+        assert collection.read_preference == ReadPreference.PRIMARY
+    if policy == 'majority_write':
+        assert collection.write_concern == WriteConcern(
+            'majority', wtimeout=WRITE_TIMEOUT_MS)
+    elif policy == 'acknowledged_write':
+        assert collection.write_concern == WriteConcern(w=1)
+    else:
+        assert collection.write_concern == WriteConcern()
+
+
+def test_collections_outside_a_query_keep_client_defaults(database):
+    with pytest.raises(Captured) as captured:
+        database['feedback']
+
+    assert captured.value.collection.read_preference == ReadPreference.PRIMARY
+    assert captured.value.collection.write_concern == WriteConcern()
+
+
+@pytest.mark.parametrize('query, args, write_concern', [
+    (db_queries_doctors.store_photo, (io.BytesIO(b'photo'), 'photo',
+                                      'image/png'),
+     WriteConcern('majority', wtimeout=WRITE_TIMEOUT_MS)),
+    (db_queries_doctors.delete_photos, ([{'file_id': 1}],),
+     WriteConcern('majority', wtimeout=WRITE_TIMEOUT_MS)),
+    (db_queries_doctors.open_photo, ('5ec0a3d9c9e77c0001a1b2c3',), None),
+])
+def test_photo_bucket_follows_policy(monkeypatch, database, query, args,
+                                     write_concern):
+    def bucket(db, **options):
+        raise Captured(options)
+    monkeypatch.setattr(db_queries_doctors, 'GridFSBucket', bucket)
+
+    options = collection_of(query, database, args)
+
+    assert options['bucket_name'] == db_queries_doctors.PHOTO_BUCKET
+    assert options['write_concern'] == write_concern
+    assert options['read_preference'] is None
+
+
+class RecordingCollection:
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            return name, kwargs
+        return method
+
+
+@pytest.mark.parametrize('method, option', sorted(
+    PolicyCollection.TIME_LIMIT_OPTIONS.items()))
+def test_reads_get_max_time_ms(method, option):
+    collection = PolicyCollection(RecordingCollection(), MAX_TIME_MS)
+
+    assert getattr(collection, method)({}) == (method, {option: MAX_TIME_MS})
+
+
+def test_explicit_time_limit_wins():
+    collection = PolicyCollection(RecordingCollection(), MAX_TIME_MS)
+
+    assert collection.aggregate([], maxTimeMS=10) == \
+        ('aggregate', {'maxTimeMS': 10})
+    assert collection.insert_one({}) == ('insert_one', {})
@@ -0,0 +1,110 @@
+import datetime as dt
+
+import mongomock
+import pytest
+from bson import ObjectId
+
+from app.database.pagination import (DEFAULT_PAGE_SIZE, InvalidPageToken,
+                                     decode_page_token, encode_page_token,
+                                     find_page)
+
+DAY = dt.datetime(2020, 5, 1)
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.items
+
+
+def all_pages(collection, limit, projection=None):
+    pages, token = [], None
+    while True:
+        documents, token = find_page(collection, {}, projection or {},
+                                     'date', limit=limit, next_token=token)
+        pages.append(documents)
+        if token is None:
+            return pages
+
+
+def test_equal_sort_keys_are_paged_by_id(collection):
+    ids = [collection.insert_one({'date': DAY, 'n': n}).inserted_id
+           for n in range(7)]
+
+    pages = all_pages(collection, 3)
+
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert [document['_id'] for page in pages for document in page] == \
+        sorted(ids, reverse=True)
+
+
+def test_documents_without_sort_key_come_last(collection):
+    collection.insert_many([{'date': DAY + dt.timedelta(days=n), 'n': n}
+                            for n in range(3)] +
+                           [{'n': n} for n in range(3, 6)])
+
+    pages = all_pages(collection, 2, {'_id': 0, 'n': 1})
+
+    assert [document for page in pages for document in page] == \
+        [{'n': 2}, {'n': 1}, {'n': 0}, {'n': 5}, {'n': 4}, {'n': 3}]
+
+
+def test_default_page_size(collection):
+    collection.insert_many([{'date': DAY, 'n': n}
+                            for n in range(DEFAULT_PAGE_SIZE + 1)])
+
+    documents, token = find_page(collection, {}, {}, 'date')
+
+    assert len(documents) == DEFAULT_PAGE_SIZE
+    assert token is not None
+
+
+def test_streaming_without_limit_returns_every_document(collection):
+    collection.insert_many([{'date': DAY, 'n': n}
+                            for n in range(DEFAULT_PAGE_SIZE + 1)])
+
+    cursor, token = find_page(collection, {}, {}, 'date', stream_batch_size=10)
+
+    assert len(list(cursor)) == DEFAULT_PAGE_SIZE + 1
+    assert token is None
+
+
+def test_page_token_round_trip():
+    last_id = ObjectId()
+
+    assert decode_page_token('date', encode_page_token('date', DAY, last_id)) \
+        == (DAY, last_id)
+    assert decode_page_token('date', encode_page_token('date', None, last_id)) \
+        == (None, last_id)
+
+
+@pytest.mark.parametrize('token', [
+    'not a token',
+    encode_page_token('date', DAY, ObjectId())[:-4] + 'AAAA',
+    encode_page_token('other', DAY, ObjectId()),
+    encode_page_token('date', DAY, 'not an id'),
+])
+def test_tampered_token_is_rejected(token):
+    with pytest.raises(InvalidPageToken):
+        decode_page_token('date', token)
+
+
+def test_feedback_pages_by_default(client, db, auth_headers, application):
+    db['feedback'].insert_many(
+        [{'_feedback_date': DAY, 'n': n}
+         for n in range(application.DEFAULT_PAGE_SIZE + 1)])
+
+    response = client.get('/feedback', headers=auth_headers)
+
+    assert response.status_code == 200
+    assert len(response.get_json()['message']) == application.DEFAULT_PAGE_SIZE
+    assert response.get_json()['next']
+
+
+def test_feedback_tampered_token_is_400(client, db, auth_headers):
+    db['feedback'].insert_one({'_feedback_date': DAY})
+
+    response = client.get('/feedback?limit=1&next=tampered',
+                          headers=auth_headers)
+
+    assert response.status_code == 400
+    assert response.get_json()['code'] == 'invalid page token'
@@ -0,0 +1,39 @@
+import logging
+
+from app.database.report_cache import ReportCache
+
+
+class FailingDatabase:
+
+    def watch(self, *args, **kwargs):
+        raise TypeError('change streams are not supported')
+
+
+def test_failed_watch_falls_back_to_short_ttl(caplog):
+    cache = ReportCache(ttl=60, fallback_ttl=1)
+
+    with caplog.at_level(logging.DEBUG, 'app.database.report_cache'):
+        for _ in range(3):
+            cache.watch(FailingDatabase())
+
+    assert not cache.watching
+    assert [record.levelno for record in caplog.records] == \
+        [logging.WARNING, logging.DEBUG, logging.DEBUG]
+    assert all(record.exc_info is None for record in caplog.records)
+
+
+def test_changes_drop_the_entries_of_their_report():
+    cache = ReportCache()
+    loads = []
+
+    def load(key):
+        return cache.load(key, lambda: loads.append(key) or len(loads))
+
+    load(('report', 'r1'))
+    load(('diagnostic', 'r2'))
+    cache.apply_change({'operationType': 'update',
+                        'fullDocument': {'report_id': 'r1'}})
+    load(('report', 'r1'))
+    load(('diagnostic', 'r2'))
+
+    assert loads == [('report', 'r1'), ('diagnostic', 'r2'), ('report', 'r1')]
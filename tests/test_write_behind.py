@@ -0,0 +1,107 @@
+import os
+from bson import json_util
+
+from app.database.write_behind import WriteBehindBuffer, _try_lock
+
+
+class Recorder:
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.batches = []
+
+    def __call__(self, documents):
+        if self.fail:
+            raise OSError('mongo is down')
+        self.batches.append(documents)
+
+    @property
+    def documents(self):
+        return [document for batch in self.batches for document in batch]
+
+
+def buffer(directory, flush):
+    return WriteBehindBuffer('feedback', flush, str(directory),
+                             flush_interval=0.01, retry_interval=0.01)
+
+
+def write_segment(directory, owner, sequence, documents, tail=''):
+    path = directory / ('feedback-%s-%d.jsonl' % (owner, sequence))
+    path.write_text(''.join(json_util.dumps(document) + '\n'
+                            for document in documents) + tail)
+    return path
+
+
+def files(directory):
+    return sorted(path.name for path in directory.iterdir())
+
+
+def test_put_documents_are_flushed_on_close(tmp_path):
+    flush = Recorder()
+    feedback = buffer(tmp_path, flush)
+
+    for n in range(3):
+        feedback.put({'n': n})
+    feedback.close()
+
+    assert flush.documents == [{'n': 0}, {'n': 1}, {'n': 2}]
+    assert files(tmp_path) == []
+
+
+def test_segments_of_a_crashed_owner_are_recovered(tmp_path):
+    write_segment(tmp_path, 'crashed', 1, [{'n': 0}, {'n': 1}])
+    write_segment(tmp_path, 'crashed', 2, [{'n': 2}], tail='{"n": 3')
+    (tmp_path / 'feedback-crashed.lock').touch()
+    flush = Recorder()
+    feedback = buffer(tmp_path, flush)
+
+    feedback.put({'n': 4})
+    feedback.close()
+
+    # The truncated line was never acknowledged, so it is dropped.
+    assert flush.documents == [{'n': 0}, {'n': 1}, {'n': 2}, {'n': 4}]
+    assert files(tmp_path) == []
+
+
+def test_segments_without_lock_file_are_recovered(tmp_path):
+    write_segment(tmp_path, 'crashed', 1, [{'n': 0}])
+    flush = Recorder()
+    feedback = buffer(tmp_path, flush)
+
+    feedback.put({'n': 1})
+    feedback.close()
+
+    assert flush.documents == [{'n': 0}, {'n': 1}]
+
+
+def test_segments_of_a_live_owner_are_left_alone(tmp_path):
+    segment = write_segment(tmp_path, 'live', 1, [{'n': 0}])
+    descriptor = _try_lock(str(tmp_path / 'feedback-live.lock'))
+    flush = Recorder()
+    feedback = buffer(tmp_path, flush)
+
+    try:
+        feedback.put({'n': 1})
+        feedback.close()
+    finally:
+        os.close(descriptor)
+
+    assert flush.documents == [{'n': 1}]
+    assert files(tmp_path) == [segment.name, 'feedback-live.lock']
+
+
+def test_unwritten_documents_are_recovered_by_the_next_buffer(tmp_path):
+    failing = buffer(tmp_path, Recorder(fail=True))
+    failing.put({'n': 0})
+    failing.close(timeout=5)
+    # The lock is released when the process exits.
+    os.close(failing._owner_lock)
+    assert any(name.endswith('.jsonl') for name in files(tmp_path))
+
+    flush = Recorder()
+    feedback = buffer(tmp_path, flush)
+    feedback.put({'n': 1})
+    feedback.close()
+
+    assert flush.documents == [{'n': 0}, {'n': 1}]
+    assert files(tmp_path) == []